@@ -0,0 +1,318 @@
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Benchmarks for every pipeline stage: python -m src.benchmark
+#
+# Each measurement runs in a freshly spawned process, so peak memory is that of the
+# stage alone and one stage's caches or allocations cannot leak into the next. Runs
+# are written as JSON (one record per stage and size) and can be saved as a baseline;
+# later runs are compared against it and slower stages are flagged as regressions.
+# Everything runs locally: decks are generated into a temporary folder.
+
+STAGES = ['generate_data', 'load_decks', 'score_deck', 'process_deck_batch', 'process_all_decks', 'get_heatmaps']
+SIZES = [1_000, 100_000, 1_000_000]
+
+# Baselines are machine specific, so none is checked in: record one per machine with --save-baseline
+DEFAULT_BASELINE = 'benchmarks/baseline.json'
+
+# Cold-start import budget (seconds, measured in a fresh interpreter) for the modules
+# pool workers and scripts import to score decks; numpy alone is about 0.1 s. None of
+# them may load tqdm or a plotting library at import time.
+IMPORT_BUDGET = {'src.simulation': 0.5, 'src.processing': 0.5, 'src.visualization': 0.5}
+HEAVY_MODULES = ['tqdm', 'pandas', 'matplotlib', 'seaborn', 'plotly']
+
+# The pure-Python single-deck paths take minutes at a million decks; they are
+# only run up to these sizes unless --full is given.
+DEFAULT_LIMITS = {'score_deck': 1_000, 'process_deck_batch': 100_000}
+
+
+def __rss_mb():
+    """Current resident set size of this process in MB (Linux)."""
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def __peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in kB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def __deck_path(workdir, n_decks):
+    """Deck file used by the stages that read decks of a given size."""
+    return os.path.join(workdir, f'size_{n_decks}', 'data', 'deck_data.npy')
+
+
+def __prepare(workdir, n_decks):
+    """Generate the deck file (and a results file for get_heatmaps) for one size, untimed."""
+    import src.simulation as simulation
+    import src.processing as processing
+
+    folder = os.path.join(workdir, f'size_{n_decks}')
+    os.makedirs(os.path.join(folder, 'data'), exist_ok=True)
+    os.makedirs(os.path.join(folder, 'figures'), exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        simulation.generate_data(n_decks)
+        decks = processing.load_decks(__deck_path(workdir, n_decks))
+        processing.save_results(processing.process_all_decks(decks[:min(n_decks, 10_000)], workers=1),
+                                os.path.join(folder, 'results', 'results.json'))
+    finally:
+        os.chdir(cwd)
+
+
+def __prepare_quietly(workdir, n_decks):
+    """__prepare without its prints and progress bars."""
+    import contextlib
+    import io
+
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        __prepare(workdir, n_decks)
+
+
+def __run_stage(stage, workdir, n_decks, workers):
+    """Run one stage once and return the number of (deck, pair) scorings it did."""
+    import src.processing as processing
+
+    folder = os.path.join(workdir, f'size_{n_decks}')
+    path = __deck_path(workdir, n_decks)
+    n_pairs = len(processing.VALID_PAIRS)
+    if stage == 'generate_data':
+        import src.simulation as simulation
+        cwd = os.getcwd()
+        os.makedirs(os.path.join(folder, 'generated', 'data'), exist_ok=True)
+        os.chdir(os.path.join(folder, 'generated'))
+        try:
+            simulation.generate_data(n_decks)
+        finally:
+            os.chdir(cwd)
+        return None
+    if stage == 'load_decks':
+        np.array(processing.load_decks(path))  # read every page, not just the header
+        return None
+    if stage == 'score_deck':
+        decks = [format(int(mask), '052b') for mask in processing.load_decks(path)[:n_decks]]
+        for deck in decks:
+            for seq1, seq2 in processing.VALID_PAIRS:
+                processing.calculate_winner(*processing.score_deck(deck, seq1, seq2, 52))
+        return n_decks * n_pairs
+    if stage == 'process_deck_batch':
+        decks = [format(int(mask), '052b') for mask in processing.load_decks(path)[:n_decks]]
+        for deck in decks:
+            processing.process_deck_batch(deck, processing.VALID_PAIRS, 50)
+        return n_decks * n_pairs
+    if stage == 'process_all_decks':
+        processing.process_all_decks(processing.load_decks(path), workers=workers)
+        return n_decks * n_pairs
+    if stage == 'get_heatmaps':
+        import matplotlib
+        matplotlib.use('Agg')
+        import src.visualization as visualization
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            visualization.get_heatmaps('png', os.path.join(folder, 'results', 'results.json'))
+        finally:
+            os.chdir(cwd)
+        return None
+    raise ValueError(f"Unknown stage {stage!r}; choose from {STAGES}.")
+
+
+def __measure(stage, workdir, n_decks, workers):
+    """Time one stage in the current (fresh) process and record its memory use."""
+    import contextlib
+    import io
+    import src.processing  # imported up front so stage memory does not include the imports
+    import src.simulation
+
+    # Keep the stages' own prints and progress bars out of the report
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        rss_before = __rss_mb()
+        start = time.perf_counter()
+        pair_scorings = __run_stage(stage, workdir, n_decks, workers)
+        seconds = time.perf_counter() - start
+    peak = __peak_rss_mb()
+    return {
+        'stage': stage,
+        'n_decks': None if stage == 'get_heatmaps' else n_decks,
+        'seconds': seconds,
+        'decks_per_sec': None if stage == 'get_heatmaps' else n_decks / seconds,
+        'ns_per_pair': None if pair_scorings is None else seconds / pair_scorings * 1e9,
+        'peak_rss_mb': peak,
+        'stage_rss_mb': max(0.0, peak - rss_before),
+    }
+
+
+def __in_fresh_process(function, *args):
+    """Call function(*args) in a newly spawned interpreter and return its result."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def import_times(budget=IMPORT_BUDGET, repeat=3):
+    """
+    Measure the cold-start import time of each module against its budget.
+
+    Each import runs in a new interpreter (the fastest of repeat runs is kept), and
+    the heavy optional modules it loaded are listed. Returns one record per module.
+    """
+    import subprocess
+
+    records = []
+    for module, limit in budget.items():
+        code = (f"import sys, time, json; start = time.perf_counter(); import {module}; "
+                f"seconds = time.perf_counter() - start; "
+                f"print(json.dumps([seconds, sorted({{name.split('.')[0] for name in sys.modules}} & {set(HEAVY_MODULES)!r})]))")
+        runs = [json.loads(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                          check=True).stdout) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        heavy = runs[0][1]
+        records.append({'module': module, 'seconds': seconds, 'budget': limit, 'heavy_modules': heavy,
+                        'ok': seconds <= limit and not heavy})
+    return records
+
+
+def machine_info():
+    """Describe the machine a run was made on, so baselines from different boxes are not mixed up."""
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'cpus': os.cpu_count(), 'processor': platform.processor()}
+
+
+def run_benchmarks(sizes=SIZES, stages=STAGES, full=False, repeat=1, workers=1, workdir=None):
+    """
+    Run every stage at every size and return the run as a dict.
+
+    Each (stage, size) is measured repeat times, each time in a fresh process, and
+    the fastest is kept. Sizes above DEFAULT_LIMITS are skipped for the pure-Python
+    stages unless full is True; get_heatmaps does not depend on the number of decks
+    and is measured once. workers is passed to process_all_decks (1 keeps the
+    numbers comparable between machines with different core counts).
+    """
+    imports = import_times()
+    for record in imports:
+        print(f"import {record['module']:<26}{record['seconds']:>9.3f} s (budget {record['budget']} s)"
+              + (f", loads {', '.join(record['heavy_modules'])}" if record['heavy_modules'] else ""))
+
+    cleanup = workdir is None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='penney_bench_'))
+    records = []
+    try:
+        for n_decks in sizes:
+            print(f"Preparing {n_decks:,} decks...")
+            __in_fresh_process(__prepare_quietly, workdir, n_decks)
+            for stage in stages:
+                if not full and n_decks > DEFAULT_LIMITS.get(stage, n_decks):
+                    continue
+                if stage == 'get_heatmaps' and n_decks != sizes[0]:
+                    continue
+                runs = [__in_fresh_process(__measure, stage, workdir, n_decks, workers) for _ in range(repeat)]
+                record = min(runs, key=lambda run: run['seconds'])
+                records.append(record)
+                print(format_record(record))
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {'machine': machine_info(), 'workers': workers, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'imports': imports, 'records': records}
+
+
+def format_record(record):
+    """One line of the report."""
+    size = 'any' if record['n_decks'] is None else f"{record['n_decks']:,}"
+    line = f"{record['stage']:<20}{size:>11} decks {record['seconds']:>9.3f} s"
+    if record['decks_per_sec'] is not None:
+        line += f" {record['decks_per_sec']:>13,.0f} decks/s"
+    if record['ns_per_pair'] is not None:
+        line += f" {record['ns_per_pair']:>9.1f} ns/pair"
+    return line + f"   peak {record['peak_rss_mb']:.0f} MB (+{record['stage_rss_mb']:.0f} MB)"
+
+
+def compare(run, baseline, tolerance=0.2, memory_slack_mb=16):
+    """
+    List the stages of run that got slower or bigger than in baseline.
+
+    A stage regresses when it takes more than (1 + tolerance) times its baseline
+    time, or when its extra memory grows by more than tolerance plus memory_slack_mb
+    (small allocations are too noisy to compare). Returns a list of messages.
+    """
+    previous = {(record['stage'], record['n_decks']): record for record in baseline['records']}
+    regressions = []
+    for record in run['records']:
+        before = previous.get((record['stage'], record['n_decks']))
+        if before is None:
+            continue
+        name = f"{record['stage']} ({'any' if record['n_decks'] is None else record['n_decks']} decks)"
+        ratio = record['seconds'] / before['seconds']
+        if ratio > 1 + tolerance:
+            regressions.append(f"{name}: {record['seconds']:.3f} s vs {before['seconds']:.3f} s "
+                               f"({ratio:.2f}x slower)")
+        memory_limit = before['stage_rss_mb'] * (1 + tolerance) + memory_slack_mb
+        if record['stage_rss_mb'] > memory_limit:
+            regressions.append(f"{name}: +{record['stage_rss_mb']:.0f} MB vs +{before['stage_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main(argv=None):
+    """Command line interface: python -m src.benchmark [--sizes ...] [--baseline ...] [--save-baseline]"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m src.benchmark', description="Benchmark the Penney's game pipeline.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--full', action='store_true', help="run the pure-Python stages at every size")
+    parser.add_argument('--repeat', type=int, default=1, help="measurements per stage; the fastest is kept")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="workers for process_all_decks")
+    parser.add_argument('-o', '--output', default='benchmarks/latest.json')
+    parser.add_argument('--baseline', default=None,
+                        help=f"baseline to compare against (default {DEFAULT_BASELINE}); it must exist when given")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before flagging (0.2 = 20%%)")
+    parser.add_argument('--workdir', default=None, help="keep generated decks here instead of a temporary folder")
+    args = parser.parse_args(argv)
+    explicit_baseline = args.baseline is not None
+    args.baseline = args.baseline or DEFAULT_BASELINE
+    if explicit_baseline and not args.save_baseline and not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, nothing to compare against; record one with --save-baseline.")
+        return 1
+
+    run = run_benchmarks(args.sizes, args.stages, args.full, args.repeat, args.workers, args.workdir)
+    for path in [args.output] + ([args.baseline] if args.save_baseline else []):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(run, f, indent=1)
+    print(f"Benchmark saved to {args.output}" + (f" and {args.baseline}" if args.save_baseline else ""))
+
+    over_budget = [record for record in run['imports'] if not record['ok']]
+    for record in over_budget:
+        print(f"REGRESSION import {record['module']}: {record['seconds']:.3f} s (budget {record['budget']} s)"
+              + (f", loads {', '.join(record['heavy_modules'])}" if record['heavy_modules'] else ""))
+    if args.save_baseline:
+        return 1 if over_budget else 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}: only the import budgets were checked, no stage was compared. "
+              "Record one with --save-baseline.")
+        return 1 if over_budget else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['machine'] != run['machine']:
+        print(f"Note: the baseline was recorded on a different machine ({baseline['machine']['platform']}).")
+    regressions = compare(run, baseline, args.tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    if not regressions:
+        print(f"No regressions against {args.baseline}.")
+    return 1 if regressions or over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
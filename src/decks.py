@@ -0,0 +1,289 @@
+import json
+import os
+import numpy as np
+
+# Packed deck files are a plain 1-D uint64 .npy (one bitmask per deck, first card
+# in the most significant bit, so mask == int(deck_string, 2)) plus a small JSON
+# sidecar with the deck length and the seeds the decks were generated from.
+PACKED_FORMAT = 'packed-uint64'
+
+
+def cards_from_strings(decks, deck_length: int = 52) -> np.ndarray:
+    """
+    Converts deck strings of '0'/'1' characters into a card array.
+
+    Parameters:
+    - decks: iterable of str, decks as strings of '0' (black) and '1' (red).
+    - deck_length: int, number of cards in each deck.
+
+    Returns:
+    - np.ndarray: (n_decks, deck_length) uint8 array of 0/1 cards.
+    """
+    joined = ''.join(decks).encode('ascii')
+    cards = np.frombuffer(joined, dtype=np.uint8).reshape(-1, deck_length)
+    return cards - ord('0')
+
+
+def pack_decks(cards: np.ndarray) -> np.ndarray:
+    """
+    Packs a card array into one uint64 bitmask per deck.
+
+    Parameters:
+    - cards: np.ndarray, (n_decks, deck_length) array of 0/1 cards, deck_length <= 64.
+
+    Returns:
+    - np.ndarray: (n_decks,) uint64 bitmasks with the first card in the highest used bit.
+    """
+    cards = np.asarray(cards, dtype=np.uint8)
+    n_decks, deck_length = cards.shape
+    packed = np.packbits(cards, axis=1)  # big-endian bytes, padded with zero bits
+    buffer = np.zeros((n_decks, 8), dtype=np.uint8)
+    buffer[:, 8 - packed.shape[1]:] = packed
+    masks = buffer.view('>u8').ravel().astype(np.uint64)
+    return masks >> np.uint64(8 * packed.shape[1] - deck_length)
+
+
+def unpack_decks(masks: np.ndarray, deck_length: int = 52) -> np.ndarray:
+    """
+    Unpacks uint64 bitmasks back into a card array.
+
+    Parameters:
+    - masks: np.ndarray, (n_decks,) uint64 bitmasks as produced by pack_decks.
+    - deck_length: int, number of cards in each deck.
+
+    Returns:
+    - np.ndarray: (n_decks, deck_length) uint8 array of 0/1 cards.
+    """
+    masks = np.asarray(masks, dtype=np.uint64) << np.uint64(64 - deck_length)
+    buffer = masks.astype('>u8').view(np.uint8).reshape(-1, 8)
+    return np.unpackbits(buffer, axis=1)[:, :deck_length]
+
+
+def metadata_path(path: str) -> str:
+    """Returns the path of the JSON sidecar that belongs to a packed deck file."""
+    return os.path.splitext(path)[0] + '.json'
+
+
+def seeds_path(path: str) -> str:
+    """Returns the path of the explicit seed array that belongs to a packed deck file."""
+    return os.path.splitext(path)[0] + '_seeds.npy'
+
+
+def save_packed(path: str, masks: np.ndarray, deck_length: int = 52, first_seed: int = 1,
+                seeds: np.ndarray = None, **metadata) -> None:
+    """
+    Saves packed decks and their metadata sidecar.
+
+    Parameters:
+    - path: str, .npy path for the bitmasks; the sidecar is written next to it.
+    - masks: np.ndarray, (n_decks,) uint64 bitmasks.
+    - deck_length: int, number of cards in each deck.
+    - first_seed: int, seed of the first deck; deck i has seed first_seed + i.
+    - seeds: np.ndarray, optional explicit seeds when they are not a contiguous range.
+    - metadata: extra JSON-serializable fields to store in the sidecar.
+
+    Returns:
+    - None
+    """
+    np.save(path, np.asarray(masks, dtype=np.uint64))
+    if seeds is not None:
+        np.save(seeds_path(path), np.asarray(seeds, dtype=np.int64))
+    write_metadata(path, n_decks=len(masks), deck_length=deck_length,
+                   first_seed=None if seeds is not None else first_seed, **metadata)
+
+
+def write_metadata(path: str, n_decks: int, deck_length: int = 52, first_seed: int = 1, **metadata) -> None:
+    """
+    Writes the JSON sidecar for a packed deck file.
+
+    The sidecar is written to a temporary file, synced and renamed over the old one,
+    so a crash leaves either the previous sidecar or the new one, never a torn file.
+    """
+    info = {'format': PACKED_FORMAT, 'n_decks': int(n_decks), 'deck_length': deck_length,
+            'first_seed': first_seed}
+    info.update(metadata)
+    temporary = metadata_path(path) + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(info, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, metadata_path(path))
+
+
+def read_metadata(path: str) -> dict:
+    """Reads the JSON sidecar for a packed deck file."""
+    with open(metadata_path(path)) as f:
+        return json.load(f)
+
+
+def __read_header(path: str):
+    """Returns (shape, dtype, data offset) from the header of a .npy file."""
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+        return shape, dtype, f.tell()
+
+
+def is_packed(path: str) -> bool:
+    """Checks whether a .npy file holds packed uint64 decks rather than the legacy object array."""
+    _, dtype, _ = __read_header(path)
+    return dtype == np.uint64
+
+
+def open_packed(path: str) -> np.ndarray:
+    """
+    Memory-maps packed decks, so large files open instantly and are paged in on demand.
+
+    Files still being written by write_packed (or left behind by an interrupted run)
+    are read up to their last committed chunk, as recorded in the sidecar.
+
+    Parameters:
+    - path: str, .npy path of the bitmasks.
+
+    Returns:
+    - np.ndarray: read-only (n_decks,) uint64 memmap of bitmasks.
+    """
+    shape, dtype, offset = __read_header(path)
+    committed = shape[0]
+    if os.path.exists(metadata_path(path)):
+        committed = min(committed, read_metadata(path).get('committed', committed))
+    if committed == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(committed,))
+
+
+def resume_point(path: str, **expected) -> int:
+    """
+    Number of decks an interrupted write_packed run already committed to path.
+
+    Returns 0 (start over) unless the file and its sidecar exist, the run did not
+    finish, and every expected metadata field (n_decks, master_seed, ...) matches.
+    """
+    if not (os.path.exists(path) and os.path.exists(metadata_path(path))):
+        return 0
+    info = read_metadata(path)
+    if info.get('complete', True) or any(info.get(key) != value for key, value in expected.items()):
+        return 0
+    return int(info.get('committed', 0))
+
+
+def write_packed(path: str, blocks, n_decks: int, deck_length: int = 52, first_seed: int = 1,
+                 start: int = 0, fsync_every: int = 16, progress=None, **metadata) -> None:
+    """
+    Writes packed decks block by block into a preallocated .npy file on disk.
+
+    The file is created at its full size with open_memmap and each block is written
+    in place, so memory use does not depend on n_decks. Every fsync_every blocks the data is flushed and fsynced, and
+    then the sidecar's 'committed' count is advanced; open_packed never reads past
+    it, and resume_point lets an interrupted run continue from there.
+
+    Parameters:
+    - path: str, .npy path for the bitmasks.
+    - blocks: iterable of (block,) uint64 bitmask arrays, starting at deck start.
+    - n_decks: int, total number of decks in the file.
+    - deck_length: int, number of cards in each deck.
+    - first_seed: int, seed of the first deck (None when decks have no per-deck seeds).
+    - start: int, number of decks already committed; 0 creates a new file.
+    - fsync_every: int, number of blocks between commits.
+    - progress: optional progress bar to update with each block.
+    - metadata: extra JSON-serializable fields to store in the sidecar.
+
+    Returns:
+    - None
+    """
+    if start == 0:
+        # Creates the header and a sparse file of the full size without touching the data
+        masks = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint64, shape=(n_decks,))
+        del masks
+        write_metadata(path, n_decks, deck_length, first_seed, committed=0, complete=False, **metadata)
+    _, _, offset = __read_header(path)
+
+    # Blocks are written with plain file writes rather than through a memmap, so the
+    # written pages never count towards this process's memory
+    with open(path, 'rb+') as f:
+        def commit(committed, complete=False):
+            f.flush()
+            os.fsync(f.fileno())
+            write_metadata(path, n_decks, deck_length, first_seed, committed=committed, complete=complete,
+                           **metadata)
+
+        position = start
+        for i, block in enumerate(blocks, 1):
+            f.seek(offset + 8 * position)
+            f.write(np.ascontiguousarray(block, dtype=np.uint64).tobytes())
+            position += len(block)
+            if progress is not None:
+                progress.update(len(block))
+            if i % fsync_every == 0:
+                commit(position)
+        commit(position, complete=position == n_decks)
+
+
+def load_seeds(path: str) -> np.ndarray:
+    """
+    Returns the seed of every deck in a packed deck file.
+
+    Parameters:
+    - path: str, .npy path of the bitmasks.
+
+    Returns:
+    - np.ndarray: (n_decks,) int64 seeds.
+    """
+    info = read_metadata(path)
+    if info.get('generator') == 'batched':
+        raise ValueError(f"{path} was generated from master seed {info['master_seed']}; its decks have no per-deck seeds.")
+    if info.get('first_seed') is None:
+        return np.load(seeds_path(path), mmap_mode='r')
+    return np.arange(info['first_seed'], info['first_seed'] + info['n_decks'], dtype=np.int64)
+
+
+def convert_legacy(src_path: str, dst_path: str = None, chunk_size: int = 1_000_000) -> str:
+    """
+    Converts a legacy object-dtype deck_data .npy file into the packed format.
+
+    The legacy array has to be unpickled once, but the decks are packed and written
+    to the output chunk by chunk, so no second full-size copy is ever built.
+
+    Parameters:
+    - src_path: str, legacy (n, 2) [seed, deck string] .npy file.
+    - dst_path: str, output .npy path; defaults to <src>_packed.npy.
+    - chunk_size: int, number of decks converted at a time.
+
+    Returns:
+    - str: path of the packed file.
+    """
+    if dst_path is None:
+        dst_path = os.path.splitext(src_path)[0] + '_packed.npy'
+    data = np.load(src_path, allow_pickle=True)
+    n_decks = len(data)
+    deck_length = len(data[0, 1]) if n_decks else 52
+
+    masks = np.lib.format.open_memmap(dst_path, mode='w+', dtype=np.uint64, shape=(n_decks,))
+    for start in range(0, n_decks, chunk_size):
+        chunk = data[start:start + chunk_size, 1]
+        masks[start:start + len(chunk)] = pack_decks(cards_from_strings(chunk, deck_length))
+    masks.flush()
+    del masks
+
+    seeds = data[:, 0].astype(np.int64)
+    first_seed = int(seeds[0]) if n_decks else 1
+    if np.array_equal(seeds, np.arange(first_seed, first_seed + n_decks)):
+        write_metadata(dst_path, n_decks, deck_length, first_seed, source=os.path.basename(src_path))
+    else:
+        np.save(seeds_path(dst_path), seeds)
+        write_metadata(dst_path, n_decks, deck_length, None, source=os.path.basename(src_path))
+    return dst_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert legacy deck_data.npy files to the packed format.")
+    parser.add_argument('src', help="legacy .npy deck file")
+    parser.add_argument('dst', nargs='?', default=None, help="output .npy path (default: <src>_packed.npy)")
+    parser.add_argument('--chunk-size', type=int, default=1_000_000)
+    args = parser.parse_args()
+    print(f"Packed decks saved to {convert_legacy(args.src, args.dst, args.chunk_size)}")
@@ -0,0 +1,140 @@
+import itertools
+import sys
+import numpy as np
+import src.decks as decks_io
+import src.exact as exact
+import src.metrics as metrics
+import src.processing as processing
+import src.simulation as simulation
+import src.tournament as tournament
+
+# Equivalence checks of the fast engines against the reference scorers: python -m src.equivalence
+#
+# score_deck + calculate_winner (and score_game + game_winners for more players) are
+# the definition of the game; every vectorized engine claims to give exactly their
+# counts. This replays a few hundred seeded decks through both sides, for several
+# sequence lengths, and compares them exactly:
+#
+# - score_all_pairs: the per-deck score differences of every pair
+# - score_decks and process_deck_batch: the count matrices
+# - score_prefix_trie: the count matrices, with small blocks so several tries are built
+# - tournament.seat_counts: the per-member counts of every set of 3 and 4 players
+# - exact.exact_results: the counts over every arrangement of small decks, enumerated
+#
+# It takes a few seconds, so run it after any change to an engine; it exits with
+# status 1 if any engine disagrees.
+
+SEQ_LENS = (2, 3, 4, 5)
+PLAYERS = (3, 4)
+# (deck_length, n_red, seq_len) small enough to enumerate every arrangement
+EXACT_CASES = [(10, 5, 2), (10, 5, 3), (11, 4, 3), (12, 6, 3), (12, 6, 4)]
+
+
+def reference_counts(cards: np.ndarray, valid_pairs: list) -> tuple:
+    """(4, n_decks, n_pairs) outcome flags and (2, n_decks, n_pairs) score differences from score_deck."""
+    deck_length = cards.shape[1]
+    flags = np.zeros((4, len(cards), len(valid_pairs)), dtype=np.int64)
+    diffs = np.zeros((2, len(cards), len(valid_pairs)), dtype=np.int64)
+    for d, deck in enumerate(''.join(map(str, row)) for row in cards):
+        for k, (seq1, seq2) in enumerate(valid_pairs):
+            p1_cards, p2_cards, p1_tricks, p2_tricks = processing.score_deck(deck, seq1, seq2, deck_length)
+            cards_win, cards_draw, tricks_win, tricks_draw = processing.calculate_winner(p1_cards, p2_cards,
+                                                                                       p1_tricks, p2_tricks)
+            flags[:, d, k] = cards_win, tricks_win, cards_draw, tricks_draw
+            diffs[:, d, k] = p1_cards - p2_cards, p1_tricks - p2_tricks
+    return flags, diffs
+
+
+def check_pairs(cards: np.ndarray, seq_len: int) -> list:
+    """Compares score_all_pairs, score_decks, process_deck_batch and score_prefix_trie with score_deck."""
+    pairs = processing.valid_pairs(seq_len)
+    flags, diffs = reference_counts(cards, pairs)
+    expected = processing.pair_matrices(flags.sum(axis=1), pairs)
+    failures = []
+
+    cards_diff, tricks_diff = processing.score_all_pairs(cards, pairs, chunk_size=64)
+    if not (np.array_equal(cards_diff, diffs[0]) and np.array_equal(tricks_diff, diffs[1])):
+        failures.append(f"score_all_pairs differs from score_deck on {np.count_nonzero(cards_diff != diffs[0])} "
+                        f"(deck, pair) card scores for {seq_len}-card sequences")
+    engines = {
+        'score_decks': processing.score_decks(cards, pairs, chunk_size=64),
+        'process_deck_batch': [sum(matrices) for matrices in zip(*(
+            processing.process_deck_batch(''.join(map(str, row)), pairs, cards.shape[1] - 2) for row in cards))],
+        'score_prefix_trie': processing.score_prefix_trie(decks_io.pack_decks(cards), pairs, cards.shape[1],
+                                                          block_size=64, chunk_size=32),
+    }
+    for name, counts in engines.items():
+        if not all(np.array_equal(matrix, reference) for matrix, reference in zip(counts, expected)):
+            failures.append(f"{name} differs from score_deck for {seq_len}-card sequences")
+    return failures
+
+
+def check_tournament(cards: np.ndarray, n_players: int, seq_len: int = 3) -> list:
+    """Compares tournament.seat_counts with score_game + game_winners for every set of n_players sequences."""
+    sets = tournament.player_sets(n_players, seq_len)
+    expected = np.zeros((4, len(sets), n_players), dtype=np.int64)
+    for deck in (''.join(map(str, row)) for row in cards):
+        for s, members in enumerate(sets):
+            sequences = [format(code, f'0{seq_len}b') for code in members]
+            for member, (cards_win, cards_tie, tricks_win, tricks_tie) in enumerate(
+                    tournament.game_winners(*tournament.score_game(deck, sequences, len(deck)))):
+                expected[:, s, member] += cards_win, tricks_win, cards_tie, tricks_tie
+    counts = tournament.seat_counts(cards, sets, seq_len, chunk_size=64)
+    if not np.array_equal(counts, expected):
+        return [f"seat_counts differs from score_game on {np.count_nonzero(counts != expected)} counts "
+                f"for {n_players} players"]
+    return []
+
+
+def check_exact(deck_length: int, n_red: int, seq_len: int) -> list:
+    """Compares exact.exact_results with score_deck over every arrangement of a small deck."""
+    reds = list(itertools.combinations(range(deck_length), n_red))
+    arrangements = np.zeros((len(reds), deck_length), dtype=np.uint8)
+    for d, positions in enumerate(reds):
+        arrangements[d, list(positions)] = 1
+    pairs = processing.valid_pairs(seq_len)
+    flags, _ = reference_counts(arrangements, pairs)
+    expected = processing.pair_matrices(flags.sum(axis=1), pairs)
+    counts, n = processing.counts_from_results(exact.exact_results(deck_length, n_red, seq_len))
+    if n != len(arrangements) or not all(np.array_equal(a, b) for a, b in zip(counts, expected)):
+        return [f"exact_results differs from enumerating the {len(arrangements)} decks of "
+                f"{deck_length} cards, {n_red} red, for {seq_len}-card sequences"]
+    return []
+
+
+def run_checks(n_decks: int = 300, key: int = 1) -> list:
+    """Runs every check on n_decks counter-based decks of a Philox key; returns the failure messages."""
+    cards = next(simulation.counter_decks(0, n_decks, key=key, block_size=n_decks))
+    checks = [(f"pairs, {seq_len}-card sequences", check_pairs, (cards, seq_len)) for seq_len in SEQ_LENS]
+    checks += [(f"tournament, {n_players} players", check_tournament, (cards, n_players)) for n_players in PLAYERS]
+    checks += [(f"exact, {deck_length} cards, {n_red} red, {seq_len}-card sequences", check_exact,
+                (deck_length, n_red, seq_len)) for deck_length, n_red, seq_len in EXACT_CASES]
+    failures = []
+    for name, check, args in checks:
+        messages = check(*args)
+        print(f"{name:<48}{'FAILED' if messages else 'ok'}")
+        failures += messages
+    return failures
+
+
+def main(argv=None):
+    """Command line interface: python -m src.equivalence [--decks 300] [--key 1]"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m src.equivalence',
+                                     description="Check the fast engines against score_deck and score_game.")
+    parser.add_argument('--decks', type=int, default=300, help="number of seeded decks to compare on")
+    parser.add_argument('--key', type=int, default=1, help="Philox key of the decks")
+    args = parser.parse_args(argv)
+
+    metrics.set_progress(False)
+    failures = run_checks(args.decks, args.key)
+    for message in failures:
+        print(f"MISMATCH {message}")
+    if not failures:
+        print("Every engine matches the reference scorers.")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
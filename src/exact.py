@@ -0,0 +1,200 @@
+import math
+from fractions import Fraction
+import numpy as np
+import src.processing as processing
+
+# Exact win/tie probabilities by dynamic programming over deck states.
+#
+# A deck is a uniformly random arrangement of n_red red and (deck_length - n_red)
+# black cards, so every probability is (number of arrangements with the outcome) /
+# C(deck_length, n_red). The game restarts from scratch after every trick, so an
+# arrangement splits into segments that each end with a trick, plus a tail with no
+# trick. The DP first counts segments by (length, reds, winner), then chains them
+# over (cards dealt, reds dealt, score difference). Counts stay below 2**53 for
+# standard decks, so the float64 arithmetic is exact and rounds back to integers.
+
+
+def __segment_tables(seq1: str, seq2: str, deck_length: int, n_red: int):
+    """
+    Counts card strings that start right after a trick (or at the top of the deck).
+
+    Returns (p1_ends, p2_ends, no_trick), each of shape (deck_length + 1, n_red + 1):
+    p1_ends[k, j] is the number of strings of k cards with j reds whose first trick
+    is won by player 1 on exactly the k-th card (likewise for player 2), and
+    no_trick[k, j] the number of strings with no trick at all.
+    """
+    seq_len = len(seq1)
+    code1, code2 = int(seq1, 2), int(seq2, 2)
+    n_windows = 2 ** (seq_len - 1)
+    p1_ends = np.zeros((deck_length + 1, n_red + 1))
+    p2_ends = np.zeros((deck_length + 1, n_red + 1))
+    no_trick = np.zeros((deck_length + 1, n_red + 1))
+
+    # open[j, w]: strings of the current length with j reds, no trick yet, last cards w
+    open_strings = np.zeros((n_red + 1, n_windows))
+    open_strings[0, 0] = 1
+    no_trick[0, 0] = 1
+    for k in range(1, deck_length + 1):
+        extended = np.zeros_like(open_strings)
+        for w in range(n_windows):
+            for card in (0, 1):
+                code = (w << 1) | card
+                counts = open_strings[:, w]
+                if card:
+                    counts = np.concatenate(([0.0], counts[:-1]))
+                if k >= seq_len and code == code1:
+                    p1_ends[k] += counts
+                elif k >= seq_len and code == code2:
+                    p2_ends[k] += counts
+                else:
+                    extended[:, code % n_windows] += counts
+        open_strings = extended
+        no_trick[k] = open_strings.sum(axis=1)
+    return p1_ends, p2_ends, no_trick
+
+
+def __toeplitz(segment_counts: np.ndarray) -> np.ndarray:
+    """Turns segment counts by reds into matrices mapping reds dealt before to reds dealt after."""
+    n_lengths, size = segment_counts.shape
+    rows, cols = np.indices((size, size))
+    offsets = rows - cols
+    return np.where(offsets >= 0, segment_counts[:, np.clip(offsets, 0, None)], 0.0)
+
+
+def outcome_distribution(seq1: str, seq2: str, deck_length: int = 52, n_red: int = 26,
+                         score: str = 'cards') -> np.ndarray:
+    """
+    Number of arrangements for every final score difference between player 1 and player 2.
+
+    Parameters:
+    - seq1, seq2: str, player sequences as strings of '0' (black) and '1' (red).
+    - deck_length: int, number of cards in the deck.
+    - n_red: int, number of red cards in the deck.
+    - score: str, 'cards' or 'tricks'.
+
+    Returns:
+    - np.ndarray: float64 counts for differences -max_diff..max_diff (index max_diff is a tie),
+      where max_diff is deck_length for cards and deck_length // len(seq1) for tricks.
+      The counts sum to C(deck_length, n_red).
+    """
+    seq_len = len(seq1)
+    n_black = deck_length - n_red
+    max_diff = deck_length if score == 'cards' else deck_length // seq_len
+    p1_ends, p2_ends, no_trick = __segment_tables(seq1, seq2, deck_length, n_red)
+    p1_maps, p2_maps = __toeplitz(p1_ends), __toeplitz(p2_ends)
+
+    # at_trick[t][r, d]: arrangements of the first t cards with r reds that end with a trick
+    # (or t = 0), with score difference d - max_diff so far
+    at_trick = np.zeros((deck_length + 1, n_red + 1, 2 * max_diff + 1))
+    at_trick[0, 0, max_diff] = 1
+    totals = np.zeros(2 * max_diff + 1)
+    reds = np.arange(n_red + 1)
+    for t in range(deck_length + 1):
+        current = at_trick[t]
+        current[(reds > t) | (t - reds > n_black)] = 0
+        if not current.any():
+            continue
+        # Tail: the rest of the deck is dealt without another trick
+        tail = no_trick[deck_length - t, np.clip(n_red - reds, 0, None)] * (reds <= n_red)
+        totals += tail @ current
+
+        remaining = deck_length - t
+        p1_next = p1_maps[seq_len:remaining + 1] @ current
+        p2_next = p2_maps[seq_len:remaining + 1] @ current
+        for k in range(seq_len, remaining + 1):
+            shift = k if score == 'cards' else 1
+            at_trick[t + k][:, shift:] += p1_next[k - seq_len][:, :-shift]
+            at_trick[t + k][:, :-shift] += p2_next[k - seq_len][:, shift:]
+    return totals
+
+
+def exact_counts(seq1: str, seq2: str, deck_length: int = 52, n_red: int = 26):
+    """
+    Exact number of arrangements in which player 1 wins or ties, for one pair.
+
+    Returns:
+    - tuple: (cards_wins, tricks_wins, cards_ties, tricks_ties) as Python ints.
+    """
+    counts = {}
+    for score in ('cards', 'tricks'):
+        totals = np.rint(outcome_distribution(seq1, seq2, deck_length, n_red, score))
+        middle = len(totals) // 2
+        counts[score] = (int(totals[middle + 1:].sum()), int(totals[middle]))
+    return counts['cards'][0], counts['tricks'][0], counts['cards'][1], counts['tricks'][1]
+
+
+def exact_results(deck_length: int = 52, n_red: int = 26, seq_len: int = 3) -> dict:
+    """
+    Computes the four results matrices exactly instead of sampling decks.
+
+    The output has the same format as processing.process_all_decks, with n equal to
+    the number of distinct arrangements C(deck_length, n_red) and integer counts of
+    arrangements, so it can be rendered by visualization.get_heatmaps or used as
+    ground truth for the sampler. Only unordered pairs are computed: swapping the
+    players turns every win into a loss.
+
+    Parameters:
+    - deck_length: int, number of cards in the deck.
+    - n_red: int, number of red cards in the deck.
+    - seq_len: int, length of the players' sequences.
+
+    Returns:
+    - dict: results with probabilities, counts and n.
+    """
+    total = math.comb(deck_length, n_red)
+    if total >= 2 ** 53:
+        raise ValueError(f"C({deck_length}, {n_red}) arrangements is too many to count exactly in float64.")
+
+    n_sequences = 2 ** seq_len
+    cards_wins, tricks_wins, cards_ties, tricks_ties = [np.zeros((n_sequences, n_sequences), dtype=np.int64)
+                                                        for _ in range(4)]
+    for seq1, seq2 in processing.valid_pairs(seq_len):
+        i, j = int(seq1, 2), int(seq2, 2)
+        if i > j:
+            continue
+        cw, tw, ct, tt = exact_counts(seq1, seq2, deck_length, n_red)
+        cards_wins[i, j], tricks_wins[i, j], cards_ties[i, j], tricks_ties[i, j] = cw, tw, ct, tt
+        cards_wins[j, i], tricks_wins[j, i] = total - cw - ct, total - tw - tt
+        cards_ties[j, i], tricks_ties[j, i] = ct, tt
+
+    source = {'generator': 'exact', 'deck_length': deck_length, 'n_red': n_red, 'seq_len': seq_len}
+    return processing.results_from_counts((cards_wins, tricks_wins, cards_ties, tricks_ties), total, [source])
+
+
+def as_fractions(results: dict) -> dict:
+    """Returns the four results matrices as exact Fractions, computed from the stored counts."""
+    counts, n = processing.counts_from_results(results)
+    return {key: [[Fraction(int(count), n) for count in row] for row in matrix.tolist()]
+            for key, matrix in zip(processing.RESULT_KEYS, counts)}
+
+
+def z_scores(sampled: dict, exact: dict) -> dict:
+    """
+    Compares sampled results against exact ones, cell by cell.
+
+    Returns a dict of matrices (per results key) of (sampled - exact) / standard error,
+    where the standard error is the binomial one for the sampled decks (processing.deck_count);
+    a sampler is consistent when these look like standard normal draws. Cells with
+    zero variance (the diagonal) are 0.
+    """
+    n = processing.deck_count(sampled)
+    scores = {}
+    for key in processing.RESULT_KEYS:
+        p_exact = np.array(exact[key])
+        error = np.sqrt(p_exact * (1 - p_exact) / n)
+        diff = np.array(sampled[key]) - p_exact
+        scores[key] = np.divide(diff, error, out=np.zeros_like(diff), where=error > 0)
+    return scores
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compute exact win/tie probabilities for Penney's game.")
+    parser.add_argument('-o', '--output', default='results/exact/results.json')
+    parser.add_argument('--deck-length', type=int, default=52)
+    parser.add_argument('--n-red', type=int, default=26)
+    parser.add_argument('--seq-len', type=int, default=3)
+    args = parser.parse_args()
+    processing.save_results(exact_results(args.deck_length, args.n_red, args.seq_len), args.output)
+    print(f"Exact results saved to {args.output}")
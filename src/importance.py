@@ -0,0 +1,197 @@
+import numpy as np
+import src.metrics as metrics
+import src.processing as processing
+import src.simulation as simulation
+
+# Importance sampling for rare matchup outcomes.
+#
+# Some cells (cards[0][4] ~ 1e-5, cards[3][7] ~ 1 - 2e-5) happen so rarely that a
+# million uniform decks see them a handful of times. Here decks are dealt from a
+# mixture of color-tilted deals (simulation.tilted_decks) that make such games
+# common, and every deck is weighted by w = uniform probability / mixture
+# probability, so mean(w * outcome) stays an unbiased estimate of the uniform rate.
+# A rate close to 1 is estimated as 1 minus the rate of its complement, which is the
+# rare event.
+#
+# A single tilt gives heavy-tailed weights: the decks that matter for a cell are
+# rarely the ones a given tilt favors, and the standard errors are then too small to
+# be trusted. Weighting by the whole mixture (the balance heuristic) and dealing a
+# share of the decks uniformly bounds every weight by 1 / uniform_share, which keeps
+# the estimates and their standard errors honest for every cell at once.
+#
+# That bound only helps a cell whose rare side the uniform decks actually see, and
+# the rarest cells (rate ~ 2e-5) need about 1 / (uniform_share * rate) decks before
+# they do: below that the estimate and its standard error both miss the decks that
+# matter, and the error is far too small. Such cells are flagged as unreliable and
+# get no equivalent deck count.
+
+# (tilt, tilt_cards) deals mixed with the uniform deal: reds or blacks pushed to the top
+# of the deck, over the first 8 cards, the first 20, or the whole deck
+DEFAULT_COMPONENTS = [(tilt, tilt_cards) for tilt in (1 / 8, 1 / 4, 1 / 2, 2, 4, 8) for tilt_cards in (8, 20, 52)]
+
+# Expected number of uniform decks on a cell's rare side below which its standard error is not trusted
+MIN_UNIFORM_HITS = 1.0
+
+
+def mixture_decks(num_decks, components=DEFAULT_COMPONENTS, uniform_share=0.25, seed=1, block_size=65536,
+                  deck_length=52, n_red=26):
+    """
+    Deals decks from the uniform shuffle and the tilted components, with their mixture weights.
+
+    uniform_share of the decks are dealt uniformly and the rest evenly over the
+    components; each deck's log weight is log(uniform probability) minus the log of
+    the share-weighted average of its probabilities under all the deals. Components
+    left without decks (fewer decks than components) are dropped from the mixture.
+
+    Yields:
+    - tuple: ((block, deck_length) uint8 arrays of 0/1 cards, (block,) float64 log weights).
+    """
+    deals = [(1.0, 0)] + [(float(tilt), int(tilt_cards)) for tilt, tilt_cards in components]
+    sizes = [int(num_decks * (1 - uniform_share) / len(components))] * len(components)
+    sizes = [num_decks - sum(sizes)] + sizes
+    deals, sizes = zip(*[(deal, size) for deal, size in zip(deals, sizes) if size > 0])
+    log_shares = np.log(np.array(sizes) / num_decks)
+    for d, ((tilt, tilt_cards), size) in enumerate(zip(deals, sizes)):
+        blocks = simulation.tilted_decks(size, tilt, tilt_cards, seed=[seed, d], block_size=block_size,
+                                         deck_length=deck_length, n_red=n_red)
+        for cards, _ in blocks:
+            log_ratios = np.stack([simulation.tilt_log_ratio(cards, other, other_cards, n_red)
+                                   for other, other_cards in deals]) + log_shares[:, None]
+            peak = log_ratios.max(axis=0)
+            yield cards, -(peak + np.log(np.exp(log_ratios - peak).sum(axis=0)))
+
+
+def weighted_totals(blocks, valid_pairs=processing.VALID_PAIRS, chunk_size=2048):
+    """
+    Sums the likelihood-ratio weights of the decks with each outcome.
+
+    Takes an iterable of (cards, log_weights) blocks and returns a dict with 'n', 'w'
+    and 'w2' (sum of the weights and of their squares over all decks), and (4, n_pairs)
+    arrays 'event_w', 'event_w2' and 'hits' (weights, squared weights and number of
+    the decks with each outcome, in RESULT_KEYS order).
+    """
+    n_pairs = len(valid_pairs)
+    totals = {'n': 0, 'w': 0.0, 'w2': 0.0, 'event_w': np.zeros((4, n_pairs)), 'event_w2': np.zeros((4, n_pairs)),
+              'hits': np.zeros((4, n_pairs), dtype=np.int64)}
+    for cards, log_weights in blocks:
+        for start in range(0, len(cards), chunk_size):
+            weights = np.exp(log_weights[start:start + chunk_size])
+            cards_diff, tricks_diff = processing.score_all_pairs(cards[start:start + chunk_size], valid_pairs, chunk_size)
+            for k, outcome in enumerate((cards_diff > 0, tricks_diff > 0, cards_diff == 0, tricks_diff == 0)):
+                totals['event_w'][k] += weights @ outcome
+                totals['event_w2'][k] += (weights * weights) @ outcome
+                totals['hits'][k] += outcome.sum(axis=0)
+            totals['w'] += weights.sum()
+            totals['w2'] += (weights * weights).sum()
+        totals['n'] += len(cards)
+    return totals
+
+
+def estimates(totals):
+    """
+    Unbiased estimates of every rate from weighted_totals, with their variances.
+
+    A rate is estimated directly as mean(w * outcome) when that is at most 1/2, and
+    as 1 - mean(w * (1 - outcome)) otherwise, so the average is always over the rare
+    side of the outcome.
+
+    Returns:
+    - tuple: (4, n_pairs) arrays (rate, variance of the rate, decks that had the rare side).
+    """
+    n = totals['n']
+    direct = totals['event_w'] / n
+    direct_variance = np.maximum(totals['event_w2'] / n - direct ** 2, 0) / n
+    complement = (totals['w'] - totals['event_w']) / n
+    complement_variance = np.maximum((totals['w2'] - totals['event_w2']) / n - complement ** 2, 0) / n
+    rare_complement = direct > 0.5
+    rate = np.where(rare_complement, 1 - complement, direct)
+    variance = np.where(rare_complement, complement_variance, direct_variance)
+    hits = np.where(rare_complement, n - totals['hits'], totals['hits'])
+    return rate, variance, hits
+
+
+def importance_sample(num_decks=1_000_000, components=DEFAULT_COMPONENTS, uniform_share=0.25, seed=1,
+                      block_size=65536, seq_len=3):
+    """
+    Estimates every win and tie rate by importance sampling.
+
+    Parameters:
+    - num_decks: int, number of decks to deal in total.
+    - components: list of (tilt, tilt_cards) deals mixed with the uniform one (see simulation.tilted_decks).
+    - uniform_share: float, share of the decks dealt uniformly; weights never exceed 1 / uniform_share.
+    - seed: int, seed of the deals (each deal uses its own stream derived from it).
+    - block_size: int, number of decks generated at a time.
+    - seq_len: int, length of the players' sequences.
+
+    Returns:
+    - dict: the four rate matrices and 'n' like process_all_decks, 'std_error' (standard
+      error matrices of the rates) and 'importance' (the deals and, for every cell,
+      'equivalent_decks': how many uniform decks would give the same standard error,
+      None where it is not 'reliable', and 'hits': how many dealt decks had its rare
+      side). A cell is reliable when the uniform decks expect at least
+      MIN_UNIFORM_HITS of its rare side. The rates are weighted estimates, so there
+      are no counts and the results cannot be merged.
+    """
+    pairs = processing.valid_pairs(seq_len)
+    with metrics.stage('importance_sample', n_decks=num_decks, seq_len=seq_len):
+        blocks = mixture_decks(num_decks, components, uniform_share, seed=seed, block_size=block_size)
+        with metrics.progress(total=num_decks, desc="Processing decks") as progress:
+            totals = weighted_totals(__counted(blocks, progress), pairs)
+        rate, variance, hits = estimates(totals)
+
+    binomial = rate * (1 - rate)
+    equivalent = np.divide(binomial, variance, out=np.full_like(binomial, float(num_decks)), where=variance > 0)
+    reliable = uniform_share * num_decks * np.minimum(rate, 1 - rate) >= MIN_UNIFORM_HITS
+    results = __matrices(rate, seq_len)
+    results.update({
+        'n': num_decks,
+        'std_error': __matrices(np.sqrt(variance), seq_len),
+        'importance': {
+            'components': [[float(tilt), int(tilt_cards)] for tilt, tilt_cards in components],
+            'uniform_share': uniform_share,
+            'equivalent_decks': {key: [[None if np.isnan(value) else value for value in row] for row in matrix]
+                                 for key, matrix in __matrices(np.where(reliable, equivalent, np.nan), seq_len).items()},
+            'reliable': {key: np.array(matrix, dtype=bool).tolist() for key, matrix in __matrices(reliable, seq_len).items()},
+            'hits': __matrices(hits, seq_len),
+        },
+        'sources': [{'generator': 'tilted', 'seed': seed, 'n_decks': num_decks}],
+    })
+    return results
+
+
+def __matrices(per_pair, seq_len):
+    """
+    The four (4, n_pairs) rows as results-style {key: nested list} matrices.
+    """
+    matrices = processing.pair_matrices(per_pair, processing.valid_pairs(seq_len))
+    return {key: matrix.tolist() for key, matrix in zip(processing.RESULT_KEYS, matrices)}
+
+
+def __counted(blocks, progress):
+    """
+    Passes blocks through, advancing the progress bar.
+    """
+    for cards, log_weights in blocks:
+        yield cards, log_weights
+        progress.update(len(cards))
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="Estimate rare win/tie rates by importance sampling.")
+    parser.add_argument('--decks', type=int, default=1_000_000)
+    parser.add_argument('--uniform-share', type=float, default=0.25)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--seq-len', type=int, default=3)
+    parser.add_argument('-o', '--output-folder', default='results/importance')
+    args = parser.parse_args()
+
+    results = importance_sample(args.decks, uniform_share=args.uniform_share, seed=args.seed, seq_len=args.seq_len)
+    processing.save_results(results, os.path.join(args.output_folder, 'results.json'))
+    for key, i, j in (('cards', 0, 4), ('cards', 3, 7), ('tricks', 0, 4)):
+        equivalent = results['importance']['equivalent_decks'][key][i][j]
+        print(f"{key}[{i}][{j}] = {results[key][i][j]:.4g} +- {results['std_error'][key][i][j]:.2g} "
+              + (f"(as good as {equivalent:.3g} uniform decks)" if equivalent is not None
+                 else "(unreliable: too few decks for this cell)"))
@@ -0,0 +1,130 @@
+import contextlib
+import json
+import os
+import resource
+import time
+
+# Lightweight run instrumentation.
+#
+# Pipeline stages (generate, save, load, score, write results) are wrapped in
+# stage(), which records wall time, decks/sec, peak RSS and the bytes the stage
+# read or wrote. Records are kept in memory until write_metrics() appends them as
+# JSON lines to a metrics.jsonl file; every function that writes an output file
+# (results, decks, histograms, outcomes, tournaments, sweeps) then calls
+# write_metrics_next_to(), so the records land next to that output and never in
+# the metrics of a later, unrelated run of the same process. Each stage costs one clock read and one getrusage call, so the
+# instrumentation stays on in production runs.
+#
+# Progress bars go through progress(); set_progress(False) (or the environment
+# variable PENNEY_PROGRESS=0) turns them off completely.
+
+__records = []
+__progress = os.environ.get('PENNEY_PROGRESS', '1') != '0'
+
+
+def set_progress(enabled: bool) -> None:
+    """Turns the progress bars of generation and processing on or off."""
+    global __progress
+    __progress = enabled
+
+
+class __NoProgress:
+    """Stands in for a tqdm bar when progress bars are off."""
+
+    def __init__(self, iterable=None):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def update(self, n=1):
+        pass
+
+    def set_postfix(self, *args, **kwargs):
+        pass
+
+
+def progress(iterable=None, **kwargs):
+    """A tqdm progress bar, or an object with the same interface that does nothing when bars are off."""
+    if not __progress:
+        return __NoProgress(iterable)
+    from tqdm import tqdm  # only loaded once a bar is actually shown
+    return tqdm(iterable, **kwargs)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (ru_maxrss is in kB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextlib.contextmanager
+def stage(name: str, n_decks: int = None, **fields):
+    """
+    Times a pipeline stage and records it.
+
+    Yields the record dict, so the stage can fill in values it only knows at the
+    end (n_decks, bytes_read, bytes_written). Nothing is recorded if the stage
+    raises.
+
+    Parameters:
+    - name: str, stage name such as 'generate', 'load', 'score' or 'write_results'.
+    - n_decks: int, number of decks the stage handles, for decks/sec.
+    - fields: extra JSON-serializable values to store with the record.
+
+    Yields:
+    - dict: the record being built.
+    """
+    record = {'stage': name, 'n_decks': n_decks}
+    record.update(fields)
+    start = time.perf_counter()
+    yield record
+    seconds = time.perf_counter() - start
+    record['seconds'] = seconds
+    if record['n_decks'] is not None:
+        record['decks_per_sec'] = record['n_decks'] / seconds if seconds > 0 else None
+    record['peak_rss_mb'] = peak_rss_mb()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if children:
+        record['worker_peak_rss_mb'] = children / 1024  # largest finished worker process
+    record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    __records.append(record)
+
+
+def file_size(path: str) -> int:
+    """Size of a file in bytes, for the bytes_read/bytes_written fields."""
+    return os.path.getsize(path)
+
+
+def records() -> list:
+    """The stage records collected since the last write_metrics()."""
+    return list(__records)
+
+
+def write_metrics(path: str) -> list:
+    """
+    Appends the collected stage records to a JSONL file and clears them.
+
+    Parameters:
+    - path: str, metrics file, usually metrics.jsonl next to results.json.
+
+    Returns:
+    - list: the records that were written.
+    """
+    written = records()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        for record in written:
+            f.write(json.dumps(record) + '\n')
+    __records.clear()
+    return written
+
+
+def write_metrics_next_to(output_path: str) -> list:
+    """Appends the collected stage records to metrics.jsonl in the folder of an output file (see write_metrics)."""
+    return write_metrics(os.path.join(os.path.dirname(output_path), 'metrics.jsonl'))
@@ -0,0 +1,236 @@
+import json
+import os
+import numpy as np
+import src.decks as decks_io
+import src.metrics as metrics
+import src.processing as processing
+
+# Per-deck outcome bitsets.
+#
+# For every deck, each of the four outcomes in processing.RESULT_KEYS (cards win,
+# tricks win, cards tie, tricks tie) is stored as one bit per valid pair, packed
+# big-endian: pair k is bit 7 - k % 8 of byte k // 8. With 56 pairs that is 7 bytes
+# per outcome and 28 bytes per deck. The bits live in an (n_decks, 4, n_bytes) uint8
+# .npy with a JSON sidecar, and every estimate (totals, prefixes, subsets, bootstrap
+# resamples) is a column popcount of some rows, so nothing is ever rescored.
+OUTCOMES_FORMAT = 'outcome-bits'
+
+# BIT_TABLE[v] holds the 8 bits of byte value v, most significant first
+BIT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.int64)
+POPCOUNT = BIT_TABLE.sum(axis=1)
+
+
+def outcome_bits(decks: np.ndarray, valid_pairs: list = processing.VALID_PAIRS, chunk_size: int = 2048) -> np.ndarray:
+    """
+    Scores decks and packs each deck's outcomes into bits.
+
+    Parameters:
+    - decks: np.ndarray, (n_decks, deck_length) uint8 array of 0/1 cards.
+    - valid_pairs: list, the pairs to score; bit k belongs to valid_pairs[k].
+    - chunk_size: int, number of decks scored at a time.
+
+    Returns:
+    - np.ndarray: (n_decks, 4, ceil(n_pairs / 8)) uint8 bitsets, outcomes in RESULT_KEYS order.
+    """
+    n_bytes = -(-len(valid_pairs) // 8)
+    bits = np.empty((len(decks), 4, n_bytes), dtype=np.uint8)
+    for start in range(0, len(decks), chunk_size):
+        cards_diff, tricks_diff = processing.score_all_pairs(decks[start:start + chunk_size], valid_pairs, chunk_size)
+        for k, outcome in enumerate((cards_diff > 0, tricks_diff > 0, cards_diff == 0, tricks_diff == 0)):
+            bits[start:start + len(outcome), k] = np.packbits(outcome, axis=1)
+    return bits
+
+
+def save_outcomes(path: str, decks: np.ndarray, deck_length: int = 52, seq_len: int = 3,
+                  batch_size: int = 65536, sources: list = None) -> dict:
+    """
+    Scores decks batch by batch and writes their outcome bitsets to an .npy file.
+
+    The file is written through a memmap, so memory stays at one batch. The win/tie
+    counts are the column popcounts of the bits, so the results dict comes for free.
+    The stage metrics are appended to metrics.jsonl next to the file.
+
+    Parameters:
+    - path: str, .npy path for the bitsets; a JSON sidecar is written next to it.
+    - decks: array of decks as returned by processing.load_decks.
+    - deck_length: int, number of cards in each deck.
+    - seq_len: int, length of the players' sequences.
+    - batch_size: int, number of decks scored and written at a time.
+    - sources: list, deck sources to record (see processing.deck_source).
+
+    Returns:
+    - dict: results in the format of processing.process_all_decks.
+    """
+    pairs = processing.valid_pairs(seq_len)
+    n_decks = len(decks)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    bits = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(n_decks, 4, -(-len(pairs) // 8)))
+    with metrics.stage('score_outcomes', n_decks=n_decks, seq_len=seq_len, path=path) as record:
+        with metrics.progress(total=n_decks, desc="Processing decks") as progress:
+            for start in range(0, n_decks, batch_size):
+                batch = processing.decks_to_array(decks[start:start + batch_size], deck_length)
+                bits[start:start + len(batch)] = outcome_bits(batch, pairs)
+                progress.update(len(batch))
+        bits.flush()
+        record['bytes_written'] = metrics.file_size(path)
+    info = {'format': OUTCOMES_FORMAT, 'n_decks': n_decks, 'seq_len': seq_len, 'keys': processing.RESULT_KEYS,
+            'sources': list(sources or [])}
+    with open(decks_io.metadata_path(path), 'w') as f:
+        json.dump(info, f)
+    metrics.write_metrics_next_to(path)
+    counts = processing.pair_matrices(column_counts(bits), processing.valid_pairs(seq_len))
+    del bits
+    return processing.results_from_counts(counts, n_decks, info['sources'])
+
+
+def load_outcomes(path: str):
+    """
+    Memory-maps an outcome bitset file.
+
+    Returns:
+    - tuple: ((n_decks, 4, n_bytes) uint8 memmap, sidecar dict).
+    """
+    with open(decks_io.metadata_path(path)) as f:
+        info = json.load(f)
+    return np.load(path, mmap_mode='r'), info
+
+
+def column_counts(bits: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """
+    Popcount of every bit column: how many of the decks have each outcome for each pair.
+
+    Each byte column is reduced to a 256-bin histogram of its values, which is then
+    expanded through BIT_TABLE, so the cost is one bincount per byte column.
+
+    Parameters:
+    - bits: np.ndarray, (n_decks, 4, n_bytes) bitsets, or any subset of their rows.
+    - chunk_size: int, number of decks read at a time.
+
+    Returns:
+    - np.ndarray: (4, n_bytes * 8) int64 counts; columns past the number of pairs are 0.
+    """
+    _, n_outcomes, n_bytes = bits.shape
+    columns = n_outcomes * n_bytes
+    values = np.zeros((columns, 256), dtype=np.int64)
+    offsets = np.arange(columns, dtype=np.int64) * 256
+    for start in range(0, len(bits), chunk_size):
+        chunk = np.asarray(bits[start:start + chunk_size]).reshape(-1, columns)
+        values += np.bincount((chunk + offsets).ravel(), minlength=columns * 256).reshape(columns, 256)
+    return (values @ BIT_TABLE).reshape(n_outcomes, n_bytes * 8)
+
+
+def segment_counts(bits: np.ndarray, segment_size: int) -> np.ndarray:
+    """
+    Column popcounts of consecutive segments of segment_size decks.
+
+    Returns:
+    - np.ndarray: (n_segments, 4, n_bytes * 8) int64 counts; the last segment may be shorter.
+    """
+    return np.stack([column_counts(bits[start:start + segment_size])
+                     for start in range(0, len(bits), segment_size)])
+
+
+def subset_results(bits: np.ndarray, info: dict, index=slice(None)) -> dict:
+    """
+    Results for any subset of the decks, e.g. the first 100k (slice(0, 100_000)) or a boolean mask.
+
+    Returns:
+    - dict: results in the format of processing.process_all_decks for the selected decks.
+    """
+    selected = bits[index]
+    counts = processing.pair_matrices(column_counts(selected), processing.valid_pairs(info['seq_len']))
+    return processing.results_from_counts(counts, len(selected))
+
+
+def convergence(bits: np.ndarray, info: dict, step: int = 10_000) -> dict:
+    """
+    Estimates after the first step, 2 * step, ... decks.
+
+    Returns:
+    - dict: 'n' (the deck counts at each checkpoint) and, for each results key, an
+      (n_checkpoints, 2**seq_len, 2**seq_len) array of the running estimate.
+    """
+    pairs = processing.valid_pairs(info['seq_len'])
+    cumulative = np.cumsum(segment_counts(bits, step), axis=0)
+    n = np.minimum(np.arange(1, len(cumulative) + 1) * step, len(bits))
+    curves = {'n': n}
+    for k, key in enumerate(processing.RESULT_KEYS):
+        curves[key] = np.stack([processing.pair_matrices(counts, pairs)[k] for counts in cumulative]) / n[:, None, None]
+    return curves
+
+
+def bootstrap(bits: np.ndarray, info: dict, n_resamples: int = 1000, n_groups: int = 1000,
+              confidence: float = 0.95, seed: int = 0) -> dict:
+    """
+    Bootstrap confidence intervals for every win and tie rate.
+
+    The decks are split into n_groups consecutive groups whose counts are computed
+    once; each resample draws n_groups groups with replacement (multinomial weights),
+    so a thousand resamples cost one matrix product. Decks are independent, so
+    resampling groups of decks is a bootstrap of the decks themselves.
+
+    Returns:
+    - dict: for each results key, {'low', 'high', 'std'} matrices.
+    """
+    group_size = -(-len(bits) // n_groups)
+    groups = segment_counts(bits, group_size)
+    sizes = np.diff(np.minimum(np.arange(len(groups) + 1) * group_size, len(bits)))
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(len(groups), np.full(len(groups), 1 / len(groups)), size=n_resamples)
+    resampled = (weights @ groups.reshape(len(groups), -1)).reshape(n_resamples, *groups.shape[1:])
+    rates = resampled / (weights @ sizes)[:, None, None]
+    tail = (1 - confidence) / 2
+    low, high = np.quantile(rates, [tail, 1 - tail], axis=0)
+    std = rates.std(axis=0)
+    pairs = processing.valid_pairs(info['seq_len'])
+    intervals = {}
+    for k, key in enumerate(processing.RESULT_KEYS):
+        intervals[key] = {name: processing.pair_matrices(values, pairs)[k]
+                          for name, values in (('low', low), ('high', high), ('std', std))}
+    return intervals
+
+
+def outcomes_per_deck(bits: np.ndarray, key: str = 'cards') -> np.ndarray:
+    """Number of pairs with the given outcome on each deck (row popcount), e.g. how many matchups player 1 wins."""
+    return POPCOUNT[bits[:, processing.RESULT_KEYS.index(key)]].sum(axis=1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Store per-deck outcome bitsets and analyse them.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    score = commands.add_parser('score', help="score a deck file into <output>/outcomes.npy and results.json")
+    score.add_argument('input_path')
+    score.add_argument('-o', '--output-folder', default='results')
+    score.add_argument('--seq-len', type=int, default=3)
+    curve = commands.add_parser('convergence', help="print the running estimate of one cell")
+    curve.add_argument('outcomes_path')
+    curve.add_argument('--step', type=int, default=100_000)
+    curve.add_argument('--cell', type=int, nargs=2, default=[0, 1], metavar=('ROW', 'COL'))
+    interval = commands.add_parser('bootstrap', help="save bootstrap intervals next to the outcomes file")
+    interval.add_argument('outcomes_path')
+    interval.add_argument('--resamples', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == 'score':
+        decks = processing.load_decks(args.input_path)
+        path = os.path.join(args.output_folder, 'outcomes.npy')
+        results = save_outcomes(path, decks, seq_len=args.seq_len,
+                                sources=[processing.deck_source(args.input_path, len(decks))])
+        processing.save_results(results, os.path.join(args.output_folder, 'results.json'))
+        print(f"Outcomes of {results['n']} decks saved to {path}")
+    elif args.command == 'convergence':
+        bits, info = load_outcomes(args.outcomes_path)
+        curves = convergence(bits, info, args.step)
+        row, col = args.cell
+        for n, cards, tricks in zip(curves['n'], curves['cards'][:, row, col], curves['tricks'][:, row, col]):
+            print(f"{n:>12} decks: cards {cards:.5f}  tricks {tricks:.5f}")
+    else:
+        bits, info = load_outcomes(args.outcomes_path)
+        intervals = bootstrap(bits, info, args.resamples)
+        path = os.path.splitext(args.outcomes_path)[0] + '_bootstrap.json'
+        with open(path, 'w') as f:
+            json.dump({key: {name: matrix.tolist() for name, matrix in value.items()}
+                       for key, value in intervals.items()}, f)
+        print(f"Bootstrap intervals saved to {path}")
@@ -0,0 +1,248 @@
+import functools
+import json
+import os
+import sys
+
+# Best-response lookups on a results file.
+#
+# results[score][i][j] is the probability that the player holding sequence i beats
+# the player holding sequence j (the game treats both players alike). build_index
+# turns the matrices into, for every opponent sequence and both scores ('cards' and
+# 'tricks'), the list of responses ranked by win rate, with the answers already
+# built, so a lookup is two dict reads. load_index caches indexes by path and file
+# modification time: a rewritten results file is picked up on the next lookup, an
+# unchanged one is never parsed twice.
+#
+# Sequences are given as cards ('RBB', red = 1, black = 0) or as bits ('100').
+
+SCORES = ('cards', 'tricks')
+__TIES = {'cards': 'cards_ties', 'tricks': 'tricks_ties'}
+
+
+def sequence_names(seq_len: int) -> dict:
+    '''
+    Returns every accepted spelling of every sequence of seq_len cards ('RBB', 'rbb', '100') mapped to its code.
+    '''
+    names = {}
+    for code in range(2 ** seq_len):
+        bits = format(code, f'0{seq_len}b')
+        cards = bits.replace('0', 'B').replace('1', 'R')
+        names.update({bits: code, cards: code, cards.lower(): code})
+    return names
+
+
+def build_index(results: dict) -> dict:
+    '''
+    Builds the best-response index of a results dict.
+
+    Args:
+        results: results dict as saved by processing.save_results.
+
+    Returns:
+        dict: 'names' (spelling -> code), 'labels' (code -> 'RBB' form), 'n', and for
+        each score a list indexed by the opponent's code of its ranked responses, each
+        {'sequence', 'win', 'tie', 'lose'}, best first (ties broken by the tie rate).
+    '''
+    n_sequences = len(results['cards'])
+    seq_len = n_sequences.bit_length() - 1
+    names = sequence_names(seq_len)
+    labels = [format(code, f'0{seq_len}b').replace('0', 'B').replace('1', 'R') for code in range(n_sequences)]
+    index = {'names': names, 'labels': labels, 'n': results['n'], 'seq_len': seq_len}
+    for score in SCORES:
+        wins, ties = results[score], results[__TIES[score]]
+        ranked = []
+        for opponent in range(n_sequences):
+            responses = [{'sequence': labels[mine], 'win': wins[mine][opponent], 'tie': ties[mine][opponent],
+                          'lose': wins[opponent][mine]}
+                         for mine in range(n_sequences) if mine != opponent]
+            responses.sort(key=lambda response: (response['win'], response['tie']), reverse=True)
+            ranked.append(responses)
+        index[score] = ranked
+    return index
+
+
+@functools.lru_cache(maxsize=16)
+def __cached_index(path: str, mtime_ns: int) -> dict:
+    '''
+    Returns the index of the results file at path; the modification time is part of the cache key.
+    '''
+    with open(path) as f:
+        return build_index(json.load(f))
+
+
+def load_index(results_path: str = 'results/results.json') -> dict:
+    '''
+    Returns the best-response index of a results file, built once per version of the file.
+
+    Args:
+        results_path: path of the results.json file.
+    '''
+    path = os.path.abspath(results_path)
+    return __cached_index(path, os.stat(path).st_mtime_ns)
+
+
+def best_response(index: dict, opponent: str, score: str = 'cards') -> dict:
+    '''
+    Returns the best response to the opponent's sequence: {'sequence', 'win', 'tie', 'lose'}.
+
+    Args:
+        index: index from build_index or load_index.
+        opponent: the opponent's sequence, e.g. 'RBB' or '100'.
+        score: 'cards' or 'tricks'.
+    '''
+    return index[score][__code(index, opponent)][0]
+
+
+def ranked_responses(index: dict, opponent: str, score: str = 'cards', top: int = None) -> list:
+    '''
+    Returns the responses to the opponent's sequence ranked from best to worst (the first top of them).
+    '''
+    return index[score][__code(index, opponent)][:top]
+
+
+def answer(index: dict, query: dict) -> dict:
+    '''
+    Answers one query {'opponent': 'RBB', 'score': 'cards', 'top': 1}; score and top are optional.
+
+    Returns:
+        dict: the query fields, and 'responses' (the top ranked responses), or 'error'
+        for a malformed query.
+    '''
+    if not isinstance(query, dict):
+        return {'error': f"A query must be a JSON object like {{\"opponent\": \"RBB\"}}, not {query!r}."}
+    opponent = query.get('opponent')
+    score = query.get('score', 'cards')
+    top = query.get('top', 1)
+    try:
+        if not isinstance(opponent, str):
+            raise ValueError(f"The opponent must be a sequence like 'RBB' or '100', not {opponent!r}.")
+        if score not in SCORES:
+            raise ValueError(f"Unknown score {score!r}; use one of {SCORES}.")
+        if top is not None and (not isinstance(top, int) or isinstance(top, bool) or top < 0):
+            raise ValueError(f"top must be a number of responses or null, not {top!r}.")
+        return {'opponent': opponent, 'score': score, 'responses': ranked_responses(index, opponent, score, top)}
+    except ValueError as error:
+        return {'opponent': opponent, 'score': score, 'error': str(error)}
+
+
+def __code(index: dict, sequence: str) -> int:
+    '''
+    Returns the code of a sequence spelling, or raises ValueError.
+    '''
+    code = index['names'].get(sequence)
+    if code is None:
+        raise ValueError(f"{sequence!r} is not a sequence of {index['seq_len']} cards (e.g. 'RBB' or '100').")
+    return code
+
+
+def __parse_line(line: str) -> dict:
+    '''
+    Turns an input line 'RBB', 'RBB tricks', 'RBB tricks 3' or a JSON query object into a query dict.
+    '''
+    line = line.strip()
+    if line.startswith('{'):
+        return json.loads(line)
+    fields = line.split()
+    query = {'opponent': fields[0] if fields else ''}
+    if len(fields) > 1:
+        query['score'] = fields[1]
+    if len(fields) > 2:
+        query['top'] = int(fields[2])
+    return query
+
+
+def serve_stdin(results_path: str, lines=sys.stdin, output=sys.stdout) -> None:
+    '''
+    Answers one query per input line with one JSON line, flushed right away so pipes get each answer.
+
+    Args:
+        results_path: results file to answer from; reloaded when it changes.
+        lines: iterable of query lines ('RBB', 'RBB tricks 3' or a JSON object).
+        output: file the JSON answers are written to.
+    '''
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            response = answer(load_index(results_path), __parse_line(line))
+        except (ValueError, json.JSONDecodeError) as error:
+            response = {'error': str(error)}
+        output.write(json.dumps(response) + '\n')
+        output.flush()
+
+
+def serve_http(results_path: str, host: str = '127.0.0.1', port: int = 8765) -> None:
+    '''
+    Serves queries over local HTTP until interrupted.
+
+    GET /best?opponent=RBB&score=tricks&top=3 answers one query; POST /batch with a
+    JSON list of query objects answers all of them in one round trip, which is the
+    way to send thousands of queries per second.
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class Handler(BaseHTTPRequestHandler):
+        def __reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/best':
+                return self.__reply(404, {'error': "use GET /best?opponent=RBB or POST /batch"})
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if 'top' in query:
+                try:
+                    query['top'] = int(query['top'])
+                except ValueError:
+                    return self.__reply(400, {'error': f"top must be a number of responses, not {query['top']!r}."})
+            response = answer(load_index(results_path), query)
+            self.__reply(400 if 'error' in response else 200, response)
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/batch':
+                return self.__reply(404, {'error': "use GET /best?opponent=RBB or POST /batch"})
+            try:
+                queries = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except (ValueError, TypeError) as error:
+                return self.__reply(400, {'error': str(error)})
+            if not isinstance(queries, list):
+                return self.__reply(400, {'error': "POST /batch takes a JSON list of query objects."})
+            index = load_index(results_path)
+            self.__reply(200, [answer(index, query) for query in queries])
+
+        def log_message(self, format, *args):
+            pass  # one line per query would cost more than answering it
+
+    with ThreadingHTTPServer((host, port), Handler) as server:
+        print(f"Answering best-response queries for {results_path} on http://{host}:{port}", file=sys.stderr)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Best responses from a results file.")
+    parser.add_argument('opponents', nargs='*', help="opponent sequences to answer, e.g. RBB 100")
+    parser.add_argument('-r', '--results', default='results/results.json')
+    parser.add_argument('--score', choices=SCORES, default='cards')
+    parser.add_argument('--top', type=int, default=1, help="number of ranked responses to show")
+    parser.add_argument('--stdin', action='store_true', help="answer one query per line of standard input")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="answer queries over HTTP on this port")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_http(args.results, port=args.serve)
+    elif args.stdin:
+        serve_stdin(args.results)
+    else:
+        index = load_index(args.results)
+        for opponent in args.opponents:
+            for response in ranked_responses(index, opponent, args.score, args.top):
+                print(f"vs {opponent}: play {response['sequence']} "
+                      f"(win {response['win']:.4f}, tie {response['tie']:.4f}, lose {response['lose']:.4f})")
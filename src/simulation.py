@@ -1,33 +1,40 @@
+import functools
 import numpy as np
-from tqdm import tqdm
-from typing import List
+from typing import Iterator, List
 from datetime import datetime
 import os
+import src.decks as decks
+import src.metrics as metrics
 
-def generate_data(num_iterations: int, verbose_name = False) -> None:
+def generate_data(num_iterations: int, verbose_name = False, packed: bool = True,
+                  seed: int = 1, legacy_seeds: bool = False, block_size: int = 65536,
+                  resume: bool = True, fsync_every: int = 16) -> None:
     """
     Simulates shuffling a deck of red and black cards and saves the results.
 
+    Packed decks are written block by block into a preallocated file on disk (see
+    decks.write_packed), so memory stays flat for any num_iterations and a crashed
+    run keeps every chunk committed before the crash. The generation metrics are
+    appended to metrics.jsonl next to the deck file.
+
     Parameters:
     - num_iterations: int, number of times to shuffle the deck and store the result.
     - verbose_name: bool, if true, add a timestamp and num_iterations to the filename.
+    - packed: bool, if true (default), save each deck as a uint64 bitmask (see src/decks.py).
+      If false, save the legacy object array of [seed, deck string] rows (needs legacy_seeds).
+    - seed: int, master seed of the batched generator (see generate_decks).
+    - legacy_seeds: bool, if true, shuffle deck i with np.random.seed(i + 1) like the original
+      pipeline, so old deck_data.npy runs can be reproduced exactly. Much slower.
+    - block_size: int, number of decks generated (and written) at a time.
+    - resume: bool, if true, continue an interrupted packed run with the same file name and
+      settings from its last committed chunk instead of starting over.
+    - fsync_every: int, number of blocks between commits to disk.
 
     Returns:
     - None: Saves results to a .npy file instead of returning a list.
     """
-    # Define the deck: 26 red cards (1s) and 26 black cards (0s)
-    red = '1' * 26
-    black = '0' * 26
-    deck = black + red  # Deck is now a string of '0's and '1's
-
-    # Initialize results array to store the seed and shuffled deck
-    results = np.empty((num_iterations, 2), dtype=object)
-    print(results.shape)
-    
-    for i in tqdm(range(num_iterations)):
-        seed = i + 1  # Start seed at 1 and increment by 1 for each iteration
-        shuffled_deck = __generate_sequence(deck, seed)  # Shuffle the deck with the current seed
-        results[i] = [seed, ''.join(shuffled_deck)]  # Store seed and shuffled deck
+    if not packed and not legacy_seeds:
+        raise ValueError("The legacy object format stores per-deck seeds; use legacy_seeds=True with packed=False.")
 
     # Generate the filename with num_iterations and current date and time
     current_datetime = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -37,12 +44,280 @@ def generate_data(num_iterations: int, verbose_name = False) -> None:
         filename = f"{cwd}/data/deck_data_{num_iterations}_{current_datetime}.npy"
     else:
         filename = f"{cwd}/data/deck_data.npy"
-    
-    np.save(filename, results)  # Save the results array to a .npy file in the data subfolder
 
+    if packed:
+        if legacy_seeds:
+            first_seed, metadata = 1, {}
+        else:
+            first_seed, metadata = None, {'generator': 'batched', 'master_seed': seed, 'block_size': block_size}
+        start = 0
+        if resume:
+            start = decks.resume_point(filename, n_decks=num_iterations, first_seed=first_seed, **metadata)
+        if start:
+            print(f"Resuming {filename} after {start} committed decks")
+
+        blocks = __packed_blocks(num_iterations, start, seed, legacy_seeds, block_size)
+        with metrics.stage('generate_and_save', n_decks=num_iterations - start, path=filename,
+                           generator='legacy' if legacy_seeds else 'batched') as record:
+            with metrics.progress(total=num_iterations, initial=start) as progress:
+                decks.write_packed(filename, blocks, num_iterations, deck_length=52, first_seed=first_seed,
+                                   start=start, fsync_every=fsync_every, progress=progress, **metadata)
+            record['bytes_written'] = 8 * (num_iterations - start)
+    else:
+        # The legacy object array cannot be memory-mapped, so it is built in memory and saved at the end
+        results = np.empty((num_iterations, 2), dtype=object)
+        with metrics.stage('generate', n_decks=num_iterations, generator='legacy'):
+            # Define the deck: 26 red cards (1s) and 26 black cards (0s)
+            red = '1' * 26
+            black = '0' * 26
+            deck = black + red  # Deck is now a string of '0's and '1's
+
+            for i in metrics.progress(range(num_iterations)):
+                seed_i = i + 1  # Start seed at 1 and increment by 1 for each iteration
+                shuffled_deck = __generate_sequence(deck, seed_i)  # Shuffle the deck with the current seed
+                results[i] = [seed_i, ''.join(shuffled_deck)]  # Store seed and shuffled deck
+
+        with metrics.stage('save', n_decks=num_iterations, path=filename) as record:
+            np.save(filename, results)  # Save the results array to a .npy file in the data subfolder
+            record['bytes_written'] = metrics.file_size(filename)
+
+    metrics.write_metrics_next_to(filename)
     print(f"{num_iterations} new decks saved to {filename}")
 
 
+def __packed_blocks(num_decks: int, start: int, seed: int, legacy_seeds: bool, block_size: int) -> Iterator[np.ndarray]:
+    """
+    Yields uint64 bitmask blocks for decks start, start + 1, ..., num_decks - 1.
+
+    Parameters:
+    - num_decks: int, total number of decks in the run.
+    - start: int, first deck to yield (decks before it are already on disk).
+    - seed: int, master seed of the batched generator.
+    - legacy_seeds: bool, if true, deck i is shuffled with np.random.seed(i + 1).
+    - block_size: int, number of decks per block.
+
+    Yields:
+    - np.ndarray: (block,) uint64 bitmasks.
+    """
+    if legacy_seeds:
+        deck = '0' * 26 + '1' * 26
+        for block_start in range(start, num_decks, block_size):
+            stop = min(block_start + block_size, num_decks)
+            yield np.array([int(''.join(__generate_sequence(deck, i + 1)), 2) for i in range(block_start, stop)],
+                           dtype=np.uint64)
+    else:
+        # The stream can only be replayed from the start; committed blocks are regenerated and dropped
+        position = 0
+        for block in generate_decks(num_decks, seed=seed, block_size=block_size):
+            position += len(block)
+            if position > start:
+                yield decks.pack_decks(block)
+
+
+def generate_decks(num_decks: int, seed: int = 1, block_size: int = 65536,
+                   deck_length: int = 52, n_red: int = 26) -> Iterator[np.ndarray]:
+    """
+    Generates shuffled decks in blocks from a single random generator.
+
+    Every deck is dealt card by card: the card at position j is red with probability
+    (reds left) / (cards left), drawn exactly as an integer in [0, cards left) compared
+    to the reds left. This gives a uniformly random arrangement of the red and black
+    cards, and one draw per position covers the whole block at once.
+
+    The output is fully determined by (seed, block_size): the same pair always yields
+    the same decks, but changing block_size changes the stream.
+
+    Parameters:
+    - num_decks: int, total number of decks to generate.
+    - seed: int, master seed of the np.random.Generator.
+    - block_size: int, maximum number of decks per yielded block.
+    - deck_length: int, number of cards in each deck.
+    - n_red: int, number of red cards (1s) in each deck.
+
+    Yields:
+    - np.ndarray: (block, deck_length) uint8 arrays of 0/1 cards.
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_decks, block_size):
+        size = min(block_size, num_decks - start)
+        cards = np.empty((deck_length, size), dtype=np.uint8)
+        reds_left = np.full(size, n_red, dtype=np.uint8)
+        for j in range(deck_length):
+            draw = rng.integers(0, deck_length - j, size=size, dtype=np.uint8)
+            np.less(draw, reds_left, out=cards[j].view(bool))
+            reds_left -= cards[j]
+        yield np.ascontiguousarray(cards.T)
+
+
+def counter_decks(start: int, stop: int, key: int = 1, block_size: int = 65536,
+                  deck_length: int = 52, n_red: int = 26) -> Iterator[np.ndarray]:
+    """
+    Generates decks start, start + 1, ..., stop - 1 from a counter-based generator.
+
+    Deck i is a pure function of (key, i): it is dealt from the first 52 of the 64-bit
+    words that numpy's Philox(key=key, counter=13 * i) produces (4 words per counter),
+    one word per card. numpy increments the counter before each block, so these are
+    the words of counters 13 * i + 1 ... 13 * i + 13. The card at position j is red when its word is below
+    ceil(reds left * 2**64 / cards left), which is exact up to 2**-64. Any range of
+    decks can therefore be regenerated on demand, in any order and on any worker,
+    with identical results however the range is split.
+
+    Parameters:
+    - start: int, index of the first deck.
+    - stop: int, index one past the last deck.
+    - key: int, Philox key; different keys give independent deck sequences.
+    - block_size: int, maximum number of decks per yielded block (does not change the decks).
+    - deck_length: int, number of cards in each deck.
+    - n_red: int, number of red cards (1s) in each deck.
+
+    Yields:
+    - np.ndarray: (block, deck_length) uint8 arrays of 0/1 cards.
+    """
+    counters_per_deck = -(-deck_length // 4)
+    for block_start in range(start, stop, block_size):
+        size = min(block_size, stop - block_start)
+        generator = np.random.Philox(key=key, counter=block_start * counters_per_deck)
+        words = generator.random_raw(size * 4 * counters_per_deck).reshape(size, -1)[:, :deck_length]
+        yield __deal(np.ascontiguousarray(words.T), deck_length, n_red)
+
+
+def config_decks(start: int, stop: int, configs: list, key: int = 1, block_size: int = 16384,
+                 words_per_deck: int = None) -> Iterator[list]:
+    """
+    Generates decks start, ..., stop - 1 of several deck configurations from one counter-based stream.
+
+    Deck i of every configuration is dealt from the same Philox words (the first ones of
+    the words_per_deck words of deck i), so the words are drawn once per block for all
+    the configurations and their results share the same randomness. The decks of a
+    configuration depend on words_per_deck but not on the other configurations, so
+    runs with the same words_per_deck deal the same decks; by default it is the
+    longest configuration rounded up to a whole Philox counter (4 words), which gives
+    that configuration exactly the decks of counter_decks.
+
+    Parameters:
+    - start: int, index of the first deck.
+    - stop: int, index one past the last deck.
+    - configs: list of (deck_length, n_red) configurations.
+    - key: int, Philox key.
+    - block_size: int, maximum number of decks per yielded block (does not change the decks).
+    - words_per_deck: int, multiple of 4, Philox words set aside for each deck; None fits the longest configuration.
+
+    Yields:
+    - list: one (block, deck_length) uint8 array of 0/1 cards per configuration.
+    """
+    max_length = max(deck_length for deck_length, _ in configs)
+    if words_per_deck is None:
+        words_per_deck = 4 * -(-max_length // 4)
+    if words_per_deck % 4 or words_per_deck < max_length:
+        raise ValueError(f"words_per_deck must be a multiple of 4 of at least {max_length} (the longest deck), "
+                         f"not {words_per_deck}.")
+    counters_per_deck = words_per_deck // 4
+    for block_start in range(start, stop, block_size):
+        size = min(block_size, stop - block_start)
+        generator = np.random.Philox(key=key, counter=block_start * counters_per_deck)
+        words = generator.random_raw(size * 4 * counters_per_deck).reshape(size, -1)[:, :max_length]
+        words = np.ascontiguousarray(words.T)
+        yield [__deal(words, deck_length, n_red) for deck_length, n_red in configs]
+
+
+def __deal(words: np.ndarray, deck_length: int, n_red: int) -> np.ndarray:
+    """
+    Deals decks from (>= deck_length, n_decks) uint64 words, one word per card: the card at
+    position j is red when its word is below the threshold for the reds left.
+    """
+    thresholds = __red_thresholds(deck_length, n_red)
+    size = words.shape[1]
+    cards = np.empty((deck_length, size), dtype=np.uint8)
+    reds_left = np.full(size, n_red, dtype=np.uint8)
+    for j in range(deck_length):
+        red = cards[j].view(bool)
+        np.less(words[j], thresholds[j][reds_left], out=red)
+        red |= reds_left == deck_length - j  # only reds left
+        reds_left -= cards[j]
+    return np.ascontiguousarray(cards.T)
+
+
+def tilted_decks(num_decks: int, tilt: float, tilt_cards: int = None, seed=1, block_size: int = 65536,
+                 deck_length: int = 52, n_red: int = 26) -> Iterator[tuple]:
+    """
+    Generates decks from a tilted deal, with the likelihood ratio of each deck.
+
+    Decks are dealt card by card like generate_decks, but while the first tilt_cards
+    cards are dealt, with r reds and b blacks left the next card is red with
+    probability r * tilt / (r * tilt + b) instead of r / (r + b): tilt > 1 deals reds
+    early, tilt < 1 blacks. The rest of the deck is dealt uniformly. Every arrangement
+    can still occur, and each deck comes with log(w), the log of its probability under
+    the uniform shuffle over its probability under the tilted deal, so the mean of
+    w * f(deck) is an unbiased estimate of the uniform mean of f.
+
+    Parameters:
+    - num_decks: int, total number of decks to generate.
+    - tilt: float, weight of a red card relative to a black one (1 is the uniform shuffle).
+    - tilt_cards: int, number of leading cards dealt with the tilt (default: the whole deck).
+    - seed: int or sequence of ints, seed of the np.random.Generator.
+    - block_size: int, maximum number of decks per yielded block.
+    - deck_length: int, number of cards in each deck.
+    - n_red: int, number of red cards (1s) in each deck.
+
+    Yields:
+    - tuple: ((block, deck_length) uint8 arrays of 0/1 cards, (block,) float64 log weights).
+    """
+    rng = np.random.default_rng(seed)
+    tilt_cards = deck_length if tilt_cards is None else min(tilt_cards, deck_length)
+    for start in range(0, num_decks, block_size):
+        size = min(block_size, num_decks - start)
+        cards = np.empty((deck_length, size), dtype=np.uint8)
+        reds_left = np.full(size, n_red, dtype=np.float64)
+        for j in range(deck_length):
+            card_tilt = tilt if j < tilt_cards else 1.0
+            # r * tilt + b: the tilted probabilities of red and black both divide by it
+            tilted_total = reds_left * (card_tilt - 1) + (deck_length - j)
+            np.less(rng.random(size) * tilted_total, reds_left * card_tilt, out=cards[j].view(bool))
+            reds_left -= cards[j]
+        cards = np.ascontiguousarray(cards.T)
+        yield cards, -tilt_log_ratio(cards, tilt, tilt_cards, n_red)
+
+
+def tilt_log_ratio(cards: np.ndarray, tilt: float, tilt_cards: int = None, n_red: int = 26) -> np.ndarray:
+    """
+    Log of the probability of each deck under a tilted deal over its uniform probability.
+
+    Parameters:
+    - cards: np.ndarray, (n_decks, deck_length) uint8 array of 0/1 cards.
+    - tilt, tilt_cards: the tilted deal, as in tilted_decks.
+    - n_red: int, number of red cards (1s) in each deck.
+
+    Returns:
+    - np.ndarray: (n_decks,) float64 log likelihood ratios.
+    """
+    n_decks, deck_length = cards.shape
+    tilt_cards = deck_length if tilt_cards is None else min(tilt_cards, deck_length)
+    log_ratio = np.zeros(n_decks)
+    if tilt == 1:
+        return log_ratio
+    reds_left = np.full(n_decks, n_red, dtype=np.float64)
+    for j in range(tilt_cards):
+        cards_left = deck_length - j
+        # red: tilt / (r * tilt + b) against 1 / (r + b); black: 1 / (r * tilt + b) against 1 / (r + b)
+        log_ratio += np.log(cards_left) - np.log(reds_left * (tilt - 1) + cards_left) + np.log(tilt) * cards[:, j]
+        reds_left -= cards[:, j]
+    return log_ratio
+
+
+@functools.lru_cache(maxsize=None)
+def __red_thresholds(deck_length: int, n_red: int) -> np.ndarray:
+    """
+    Returns the (deck_length, n_red + 1) uint64 table of ceil(r * 2**64 / (deck_length - j)),
+    the word below which card j is red when r reds are left (capped at 2**64 - 1).
+    """
+    table = np.zeros((deck_length, n_red + 1), dtype=np.uint64)
+    for j in range(deck_length):
+        cards_left = deck_length - j
+        for reds_left in range(min(n_red, cards_left) + 1):
+            table[j, reds_left] = min(-(-(reds_left << 64) // cards_left), 2 ** 64 - 1)
+    return table
+
+
 def __generate_sequence(seq: str, seed: int) -> List[str]:
     """
     Generates a shuffled sequence (deck) based on a seed.
@@ -0,0 +1,229 @@
+import json
+import os
+import numpy as np
+import src.metrics as metrics
+import src.processing as processing
+import src.simulation as simulation
+
+# Parameter sweeps over the deck: its length and how many of its cards are red.
+#
+# Every configuration (deck_length, n_red) of a sweep plays the same num_decks
+# counter-based decks (simulation.config_decks): the Philox words of each block are
+# drawn once and dealt into every configuration, so the configurations share their
+# randomness, which makes their differences less noisy than independent runs. The
+# deck range is split into shards that workers generate and score for all the
+# configurations at once, with the scoring tables built once per process.
+#
+# The counts of all the configurations live in one (n_configs, 4, 2**seq_len,
+# 2**seq_len) tensor, in processing.RESULT_KEYS order, saved to an .npz next to the
+# configurations, the deck count, the key, the word layout and the sources. Running a
+# sweep again on the same file only scores the configurations it does not have yet,
+# dealt from the stored word layout (Philox words per deck) so that they share their
+# decks' randomness with the stored ones; decks longer than the layout need a new file.
+SWEEP_FORMAT = 'sweep-counts'
+
+
+def parse_config(spec: str) -> tuple:
+    """
+    Reads a configuration 'deck_length:n_red' (e.g. '104:52'), or 'deck_length' for a balanced deck.
+    """
+    deck_length, _, n_red = spec.partition(':')
+    deck_length = int(deck_length)
+    return deck_length, int(n_red) if n_red else deck_length // 2
+
+
+def check_config(deck_length: int, n_red: int, seq_len: int = 3) -> None:
+    """Raises ValueError for configurations the generators and the scan cannot handle."""
+    if not seq_len <= deck_length <= 255:
+        raise ValueError(f"Deck length {deck_length} is out of range: use {seq_len} to 255 cards.")
+    if not 0 <= n_red <= deck_length:
+        raise ValueError(f"A deck of {deck_length} cards cannot have {n_red} red cards.")
+
+
+def __score_shard(args):
+    """Pool task: generate decks [start, stop) of every configuration and score them."""
+    start, stop, configs, key, block_size, seq_len, words_per_deck = args
+    pairs = processing.valid_pairs(seq_len)
+    counts = np.zeros((len(configs), 4, 2 ** seq_len, 2 ** seq_len), dtype=np.int64)
+    for block in simulation.config_decks(start, stop, configs, key=key, block_size=block_size,
+                                         words_per_deck=words_per_deck):
+        for c, cards in enumerate(block):
+            counts[c] += processing.score_decks(cards, pairs)
+    return stop - start, counts
+
+
+def score_configs(configs: list, num_decks: int, key: int = 1, workers: int = None, seq_len: int = 3,
+                  block_size: int = 16384, words_per_deck: int = None) -> np.ndarray:
+    """
+    Scores num_decks decks of every configuration.
+
+    Parameters:
+    - configs: list of (deck_length, n_red) configurations.
+    - num_decks: int, number of decks played in every configuration.
+    - key: int, Philox key of the decks.
+    - workers: int, number of processes; None uses one per core.
+    - seq_len: int, length of the players' sequences.
+    - block_size: int, number of decks generated at a time (does not change the decks).
+    - words_per_deck: int, Philox words per deck (see simulation.config_decks); None fits the longest configuration.
+
+    Returns:
+    - np.ndarray: (n_configs, 4, 2**seq_len, 2**seq_len) int64 counts.
+    """
+    for deck_length, n_red in configs:
+        check_config(deck_length, n_red, seq_len)
+    if words_per_deck is None:
+        words_per_deck = word_layout(configs)
+    check_layout(configs, words_per_deck)
+    if workers is None:
+        workers = processing.default_workers(num_decks, block_size)
+    shard_size = max(block_size, -(-num_decks // (workers * 8)))
+    shards = [(start, min(start + shard_size, num_decks), configs, key, block_size, seq_len, words_per_deck)
+              for start in range(0, num_decks, shard_size)]
+    counts = np.zeros((len(configs), 4, 2 ** seq_len, 2 ** seq_len), dtype=np.int64)
+    with metrics.stage('sweep', n_decks=num_decks, workers=workers, seq_len=seq_len,
+                       configs=[list(config) for config in configs]):
+        with metrics.progress(total=num_decks, desc=f"Sweeping {len(configs)} configurations") as progress:
+            for n_scored, shard_counts in processing.run_shards(__score_shard, shards, workers):
+                counts += shard_counts
+                progress.update(n_scored)
+    return counts
+
+
+def word_layout(configs: list) -> int:
+    """Philox words per deck that fit the longest configuration: its length rounded up to a whole counter (4 words)."""
+    return 4 * -(-max(deck_length for deck_length, _ in configs) // 4)
+
+
+def check_layout(configs: list, words_per_deck: int) -> None:
+    """Raises ValueError for a word layout that is not whole counters or cannot deal every configuration."""
+    if words_per_deck % 4:
+        raise ValueError(f"words_per_deck must be a multiple of 4, not {words_per_deck}.")
+    too_long = [deck_length for deck_length, _ in configs if deck_length > words_per_deck]
+    if too_long:
+        raise ValueError(f"Decks of {max(too_long)} cards do not fit a layout of {words_per_deck} words per deck.")
+
+
+def run_sweep(configs: list, num_decks: int, key: int = 1, workers: int = None, seq_len: int = 3,
+              block_size: int = 16384, output_path: str = None, words_per_deck: int = None) -> dict:
+    """
+    Scores every configuration that output_path does not have yet and saves them all there.
+
+    The pending configurations are dealt from the word layout of output_path when it
+    exists, so they share their randomness with the stored ones; otherwise from
+    words_per_deck, or the layout of the longest configuration when it is None. Pass a
+    larger words_per_deck to leave room for longer decks in later runs.
+
+    Returns:
+    - dict: the sweep store (see load_sweep) with the old and the new configurations.
+    """
+    configs = list(dict.fromkeys(tuple(config) for config in configs))
+    store = None
+    if output_path is not None and os.path.exists(output_path):
+        store = load_sweep(output_path)
+        if (store['n'], store['key'], store['seq_len']) != (num_decks, key, seq_len) or \
+                words_per_deck not in (None, store['words_per_deck']):
+            raise ValueError(f"{output_path} holds a sweep of {store['n']} decks with key {store['key']}, "
+                             f"seq_len {store['seq_len']} and {store['words_per_deck']} words per deck; "
+                             "use the same settings or another file.")
+        words_per_deck = store['words_per_deck']
+    done = set(store['configs']) if store else set()
+    pending = [config for config in configs if config not in done]
+    if done:
+        print(f"Skipping {len(configs) - len(pending)} configurations already in {output_path}")
+    if not pending:
+        return store
+    if words_per_deck is None:
+        words_per_deck = word_layout(configs)
+    too_long = [deck_length for deck_length, _ in pending if deck_length > words_per_deck]
+    if store and too_long:
+        raise ValueError(f"{output_path} deals decks from {words_per_deck} words per deck, too few for decks of "
+                         f"{max(too_long)} cards; sweep them into another file with a larger words_per_deck.")
+
+    counts = score_configs(pending, num_decks, key, workers, seq_len, block_size, words_per_deck)
+    stream = {'generator': 'philox', 'key': key, 'first_deck': 0, 'n_decks': num_decks,
+              'words_per_deck': words_per_deck}
+    new = {'configs': pending, 'counts': counts, 'n': num_decks, 'key': key, 'seq_len': seq_len,
+           'words_per_deck': words_per_deck, 'sources': [stream] * len(pending)}
+    if store:
+        new = {**store, 'configs': store['configs'] + pending,
+               'counts': np.concatenate([store['counts'], counts]), 'sources': store['sources'] + new['sources']}
+    if output_path is not None:
+        save_sweep(output_path, new)
+    return new
+
+
+def save_sweep(path: str, store: dict) -> None:
+    """
+    Atomically writes a sweep store to a binary .npz file (through a temporary file and a rename).
+
+    The stage metrics collected so far are appended to metrics.jsonl in the same folder.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with metrics.stage('write_sweep', path=path) as record:
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, counts=store['counts'], configs=np.array(store['configs'], dtype=np.int64).reshape(-1, 2),
+                     n=store['n'], key=store['key'], seq_len=store['seq_len'], words_per_deck=store['words_per_deck'],
+                     sources=json.dumps(store['sources']), format=SWEEP_FORMAT)
+        os.replace(path + '.tmp', path)
+        record['bytes_written'] = metrics.file_size(path)
+    metrics.write_metrics_next_to(path)
+
+
+def load_sweep(path: str) -> dict:
+    """
+    Loads a sweep store.
+
+    Returns:
+    - dict: 'configs' (list of (deck_length, n_red)), 'counts' ((n_configs, 4, 2**seq_len,
+      2**seq_len) int64), 'n', 'key', 'seq_len', 'words_per_deck' (the word layout of the
+      decks) and 'sources' (one per configuration).
+    """
+    with np.load(path) as store:
+        sources = json.loads(str(store['sources']))
+        return {
+            'configs': [(int(deck_length), int(n_red)) for deck_length, n_red in store['configs']],
+            'counts': store['counts'].astype(np.int64),
+            'n': int(store['n']),
+            'key': int(store['key']),
+            'seq_len': int(store['seq_len']),
+            # Stores written before the layout was saved recorded it in their sources
+            'words_per_deck': int(store['words_per_deck']) if 'words_per_deck' in store
+            else max(source['words_per_deck'] for source in sources),
+            'sources': sources,
+        }
+
+
+def sweep_rates(store: dict) -> dict:
+    """Win and tie rates of every configuration: for each of RESULT_KEYS, an (n_configs, 2**seq_len, 2**seq_len) array."""
+    rates = store['counts'] / store['n']
+    return {key: rates[:, k] for k, key in enumerate(processing.RESULT_KEYS)}
+
+
+def config_results(store: dict, deck_length: int, n_red: int) -> dict:
+    """The results dict of one configuration, in the format of processing.process_all_decks (for get_heatmaps)."""
+    c = store['configs'].index((deck_length, n_red))
+    return processing.results_from_counts(tuple(store['counts'][c]), store['n'], [store['sources'][c]])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Score a grid of deck lengths and red counts in one job.")
+    parser.add_argument('configs', nargs='+', help="configurations as DECK_LENGTH:N_RED, or DECK_LENGTH for half red")
+    parser.add_argument('--decks', type=int, default=1_000_000, help="decks per configuration")
+    parser.add_argument('--key', type=int, default=1)
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('--seq-len', type=int, default=3)
+    parser.add_argument('--words-per-deck', type=int, default=None,
+                        help="Philox words per deck of a new sweep file (multiple of 4); room for longer decks later")
+    parser.add_argument('-o', '--output', default='results/sweep.npz')
+    args = parser.parse_args()
+
+    store = run_sweep([parse_config(spec) for spec in args.configs], args.decks, args.key, args.workers,
+                      args.seq_len, output_path=args.output, words_per_deck=args.words_per_deck)
+    rates = sweep_rates(store)
+    for c, (deck_length, n_red) in enumerate(store['configs']):
+        # The second player picks the best response to the first player's sequence
+        response = {key: rates[key][c].max(axis=0).mean() for key in ('cards', 'tricks')}
+        print(f"{deck_length:>4} cards, {n_red:>3} red: best response wins {response['cards']:.4f} by cards, "
+              f"{response['tricks']:.4f} by tricks")
@@ -0,0 +1,319 @@
+import functools
+import itertools
+import json
+import os
+import numpy as np
+import src.metrics as metrics
+import src.processing as processing
+import src.simulation as simulation
+
+# Games of three or more players.
+#
+# Every player picks a different sequence; the deck is dealt as in score_deck and,
+# whenever the last seq_len cards form one of the sequences, its player takes the
+# pile (and a trick) and the next window starts after them. The sequences are all
+# different, so at most one of them matches a window, and the game does not depend
+# on who sits where: the scores of a seating are the scores of its set of sequences
+# in seat order. So every set of sequences (56 of 3 sequences, 70 of 4) is scanned
+# once per deck and expands to all its seatings (336 ordered 3-player tuples, 1680
+# 4-player ones) when the per-seat tensors are built.
+#
+# The scan is the lockstep scan of processing.score_all_pairs over (deck, set),
+# with the scores of all the players of a set packed into one integer, 8 bits per
+# player: the window lookup gives 1 << 8 * member for the member whose sequence it
+# is, so one add credits the right player. Scores fit as long as a player cannot
+# take more than 255 cards.
+#
+# A player wins (by cards or by tricks) with the highest score alone and ties when
+# the highest score is shared; counts are kept per set and member, in
+# processing.RESULT_KEYS order.
+TOURNAMENT_FORMAT = 'tournament-counts'
+
+
+def player_sets(n_players: int, seq_len: int = 3) -> list:
+    """Every set of n_players different sequence codes, as sorted tuples."""
+    return list(itertools.combinations(range(2 ** seq_len), n_players))
+
+
+def score_game(deck: str, sequences: list, deck_length: int = 52) -> tuple:
+    """
+    score_deck for any number of players.
+
+    Parameters:
+    - deck: str, the deck as a string of '0' (black) and '1' (red) cards.
+    - sequences: list of str, the players' (different) sequences, in seat order.
+    - deck_length: int, number of cards dealt.
+
+    Returns:
+    - tuple: (cards, tricks), lists with every seat's cards and tricks.
+    """
+    seq_len = len(sequences[0])
+    cards = [0] * len(sequences)
+    tricks = [0] * len(sequences)
+    pile = seq_len - 1
+    i = 0
+
+    while i < deck_length:
+        pile += 1
+        current = deck[i:i+seq_len]
+        if current in sequences:
+            seat = sequences.index(current)
+            cards[seat] += pile
+            tricks[seat] += 1
+            pile = seq_len - 1
+            i += seq_len
+        else:
+            i += 1
+
+    return cards, tricks
+
+
+def game_winners(cards: list, tricks: list) -> list:
+    """
+    calculate_winner for any number of players.
+
+    Returns:
+    - list: for every seat, (cards_win, cards_tie, tricks_win, tricks_tie) flags.
+    """
+    winners = []
+    for seat in range(len(cards)):
+        flags = []
+        for scores in (cards, tricks):
+            best = max(scores)
+            top = scores[seat] == best
+            shared = scores.count(best) > 1
+            flags += [int(top and not shared), int(top and shared)]
+        winners.append(tuple(flags))
+    return winners
+
+
+@functools.lru_cache(maxsize=None)
+def __credit_table(sets: tuple, seq_len: int) -> np.ndarray:
+    """
+    credit[code, c] = 1 << 8 * member if code is the sequence of that member of set c, else 0.
+    """
+    dtype = np.uint32 if len(sets[0]) <= 4 else np.uint64
+    credit = np.zeros((2 ** seq_len, len(sets)), dtype=dtype)
+    for c, members in enumerate(sets):
+        for member, code in enumerate(members):
+            credit[code, c] = 1 << (8 * member)
+    return credit
+
+
+def score_sets(decks: np.ndarray, sets: list, seq_len: int = 3, chunk_size: int = 1024) -> tuple:
+    """
+    Scores every set of sequences on every deck in one scan of the decks' window codes.
+
+    Parameters:
+    - decks: np.ndarray, (n_decks, deck_length) uint8 array of 0/1 cards, deck_length <= 255.
+    - sets: list of tuples of sequence codes (see player_sets), all of the same size.
+    - seq_len: int, length of the sequences.
+    - chunk_size: int, number of decks stepped together.
+
+    Returns:
+    - tuple: (cards, tricks), (n_players, n_decks, n_sets) uint8 arrays: [member, deck, set] is the
+      score of that member of the set.
+    """
+    decks = np.asarray(decks, dtype=np.uint8)
+    n_decks = len(decks)
+    n_players = len(sets[0])
+    credit = __credit_table(tuple(map(tuple, sets)), seq_len)
+    cards = np.empty((n_decks, len(sets)), dtype=credit.dtype)
+    tricks = np.empty((n_decks, len(sets)), dtype=credit.dtype)
+
+    shape = (min(chunk_size, n_decks), len(sets))
+    pile = np.empty(shape, dtype=np.uint8)
+    visited = np.empty(shape, dtype=bool)
+    step = np.empty(shape, dtype=credit.dtype)
+    won = np.empty(shape, dtype=credit.dtype)
+    for start in range(0, n_decks, chunk_size):
+        stop = min(start + chunk_size, n_decks)
+        size = stop - start
+        codes = np.ascontiguousarray(processing.window_codes(decks[start:stop], seq_len).T)
+        chunk_cards, chunk_tricks = cards[start:stop], tricks[start:stop]
+        chunk_pile, chunk_visited, chunk_step, chunk_won = pile[:size], visited[:size], step[:size], won[:size]
+
+        chunk_pile.fill(seq_len)
+        chunk_cards.fill(0)
+        chunk_tricks.fill(0)
+        for row in codes:
+            np.greater_equal(chunk_pile, seq_len, out=chunk_visited)
+            np.multiply(credit[row], chunk_visited, out=chunk_step)
+            chunk_tricks += chunk_step
+            np.multiply(chunk_step, chunk_pile, out=chunk_won)
+            chunk_cards += chunk_won
+            np.equal(chunk_step, 0, out=chunk_visited)
+            chunk_pile *= chunk_visited
+            chunk_pile += 1
+
+    unpack = lambda packed: np.stack([(packed >> credit.dtype.type(8 * member)) & 255
+                                      for member in range(n_players)]).astype(np.uint8)
+    return unpack(cards), unpack(tricks)
+
+
+def seat_counts(decks: np.ndarray, sets: list, seq_len: int = 3, chunk_size: int = None) -> np.ndarray:
+    """
+    Counts how often every member of every set wins and ties, by cards and by tricks.
+
+    Returns:
+    - np.ndarray: (4, n_sets, n_players) int64 counts, outcomes in RESULT_KEYS order.
+    """
+    if chunk_size is None:
+        # Keep the (decks x sets) state about as large as for the 2-player scan
+        chunk_size = max(256, 2048 * 56 // len(sets))
+    counts = np.zeros((4, len(sets), len(sets[0])), dtype=np.int64)
+    for start in range(0, len(decks), chunk_size):
+        cards, tricks = score_sets(decks[start:start + chunk_size], sets, seq_len, chunk_size)
+        for k, scores in ((0, cards), (1, tricks)):
+            # Member by member, so every operation runs over contiguous (decks x sets) arrays
+            best = scores.max(axis=0)
+            top = scores == best
+            alone = top.sum(axis=0, dtype=np.uint8) == 1
+            for member, member_top in enumerate(top):
+                wins = np.count_nonzero(member_top & alone, axis=0)
+                counts[k, :, member] += wins
+                counts[k + 2, :, member] += np.count_nonzero(member_top, axis=0) - wins
+    return counts
+
+
+def play_tournament(blocks, n_players: int = 3, seq_len: int = 3, total_decks: int = None, sources: list = None) -> dict:
+    """
+    Scores every set of n_players sequences on an iterable of deck blocks.
+
+    Parameters:
+    - blocks: iterable of (block, deck_length) uint8 arrays of 0/1 cards.
+    - n_players: int, number of players.
+    - seq_len: int, length of the players' sequences.
+    - total_decks: int, only used for the progress bar.
+    - sources: list, deck sources to record (see processing.deck_source).
+
+    Returns:
+    - dict: 'counts' ((4, n_sets, n_players) int64), 'sets', 'n', 'n_players', 'seq_len' and 'sources'.
+    """
+    sets = player_sets(n_players, seq_len)
+    counts = np.zeros((4, len(sets), n_players), dtype=np.int64)
+    n_decks = 0
+    with metrics.stage('tournament', n_decks=total_decks, n_players=n_players, seq_len=seq_len) as record:
+        with metrics.progress(total=total_decks, desc="Playing tournaments") as progress:
+            for block in blocks:
+                counts += seat_counts(block, sets, seq_len)
+                n_decks += len(block)
+                progress.update(len(block))
+        record['n_sets'] = len(sets)
+    return {'counts': counts, 'sets': sets, 'n': n_decks, 'n_players': n_players, 'seq_len': seq_len,
+            'sources': list(sources or [])}
+
+
+def simulate_tournament(num_decks: int, n_players: int = 3, seed: int = 1, block_size: int = 65536,
+                        seq_len: int = 3) -> dict:
+    """Generates num_decks decks like processing.simulate_and_process and plays every set on them."""
+    blocks = simulation.generate_decks(num_decks, seed=seed, block_size=block_size)
+    source = {'generator': 'batched', 'master_seed': seed, 'block_size': block_size, 'n_decks': num_decks}
+    return play_tournament(blocks, n_players, seq_len, num_decks, [source])
+
+
+def file_tournament(input_path: str, n_players: int = 3, seq_len: int = 3, batch_size: int = 65536) -> dict:
+    """Plays every set of n_players sequences on the decks of a deck file."""
+    decks = processing.load_decks(input_path)
+    blocks = (processing.decks_to_array(decks[start:start + batch_size])
+              for start in range(0, len(decks), batch_size))
+    return play_tournament(blocks, n_players, seq_len, len(decks), [processing.deck_source(input_path, len(decks))])
+
+
+def save_tournament(path: str, store: dict) -> None:
+    """
+    Saves tournament counts to a binary .npz file.
+
+    Only the counts of every set and member are stored (uint32 when they fit): the
+    per-seat tensors of all the seatings follow from them (see seat_tensors). A
+    4-player store is under 7 KB. The stage metrics collected so far are appended to
+    metrics.jsonl in the same folder.
+    """
+    dtype = np.uint32 if store['n'] < 2 ** 32 else np.int64
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with metrics.stage('write_tournament', path=path) as record:
+        np.savez(path, counts=store['counts'].astype(dtype), sets=np.array(store['sets'], dtype=np.uint8),
+                 n=store['n'], n_players=store['n_players'], seq_len=store['seq_len'],
+                 sources=json.dumps(store['sources']), format=TOURNAMENT_FORMAT)
+        record['bytes_written'] = metrics.file_size(path)
+    metrics.write_metrics_next_to(path)
+
+
+def load_tournament(path: str) -> dict:
+    """
+    Loads a store written by save_tournament.
+
+    Returns:
+    - dict: the same fields as play_tournament, with int64 counts.
+    """
+    with np.load(path) as store:
+        return {
+            'counts': store['counts'].astype(np.int64),
+            'sets': [tuple(int(code) for code in members) for members in store['sets']],
+            'n': int(store['n']),
+            'n_players': int(store['n_players']),
+            'seq_len': int(store['seq_len']),
+            'sources': json.loads(str(store['sources'])),
+        }
+
+
+def seat_tensors(store: dict) -> dict:
+    """
+    Per-seat win and tie rates of every seating.
+
+    Returns:
+    - dict: for each of RESULT_KEYS, an array of shape (2**seq_len,) * n_players + (n_players,):
+      [s0, s1, ..., seat] is the rate at which the player in seat `seat` wins (or ties)
+      when seat i holds sequence code s_i. Seatings that repeat a sequence are 0.
+    """
+    n_players = store['n_players']
+    sets = np.array(store['sets'], dtype=np.intp)
+    rates = store['counts'] / store['n']
+    shape = (2 ** store['seq_len'],) * n_players + (n_players,)
+    tensors = {}
+    for k, key in enumerate(processing.RESULT_KEYS):
+        tensor = np.zeros(shape)
+        for order in itertools.permutations(range(n_players)):
+            # seat i holds member order[i] of each set
+            seating = tuple(sets[:, member] for member in order)
+            for seat, member in enumerate(order):
+                tensor[seating + (seat,)] = rates[k, :, member]
+        tensors[key] = tensor
+    return tensors
+
+
+def sequence_scores(store: dict, key: str = 'cards') -> np.ndarray:
+    """Average win rate of every sequence over all the sets it plays in, (2**seq_len,) floats."""
+    k = processing.RESULT_KEYS.index(key)
+    totals = np.zeros(2 ** store['seq_len'])
+    games = np.zeros(2 ** store['seq_len'])
+    for members, rates in zip(store['sets'], store['counts'][k] / store['n']):
+        np.add.at(totals, list(members), rates)
+        np.add.at(games, list(members), 1)
+    return totals / games
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Win and tie rates of games of three or more players.")
+    parser.add_argument('players', type=int, help="number of players, e.g. 3 or 4")
+    parser.add_argument('--decks', type=int, default=1_000_000, help="decks to simulate")
+    parser.add_argument('--input', help="play on a deck file instead of simulated decks")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--seq-len', type=int, default=3)
+    parser.add_argument('-o', '--output-folder', default='results/tournament')
+    args = parser.parse_args()
+
+    if args.input:
+        store = file_tournament(args.input, args.players, args.seq_len)
+    else:
+        store = simulate_tournament(args.decks, args.players, seed=args.seed, seq_len=args.seq_len)
+    path = os.path.join(args.output_folder, f'tournament{args.players}.npz')
+    save_tournament(path, store)
+    print(f"Counts of {len(store['sets'])} sets of {args.players} sequences over {store['n']} decks saved to {path}")
+    for key in ('cards', 'tricks'):
+        scores = sequence_scores(store, key)
+        ranking = ', '.join(f"{format(code, f'0{args.seq_len}b').replace('0', 'B').replace('1', 'R')} "
+                            f"{scores[code]:.3f}" for code in np.argsort(-scores))
+        print(f"Average {key} win rate: {ranking}")
@@ -1,11 +1,17 @@
 import json
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.graph_objects as go
-import plotly.express as px
 
+# The plotting libraries are imported by the renderer that needs them (plotly for
+# html, matplotlib/seaborn for png), so importing this module stays cheap.
+
+
+def __labels(n_sequences:int) -> list:
+    '''
+    Returns the sequence labels (e.g. 'BBB' ... 'RRR') for a matrix with n_sequences rows.
+    The sequence length is log2(n_sequences), so 8x8 results get 3-card labels, 16x16 4-card ones, etc.
+    '''
+    seq_len = int(np.log2(n_sequences))
+    return [format(code, f'0{seq_len}b').replace('0', 'B').replace('1', 'R') for code in range(n_sequences)]
 
 def __final_prep(data:list) -> np.ndarray:
     data = np.array(data) # Cast
@@ -20,9 +26,10 @@ def __make_annots(wins:np.ndarray, ties:np.ndarray):
     Annot format: Win(Tie)
     '''
     annots = []
-    for i in range(8):
+    n_rows, n_cols = wins.shape
+    for i in range(n_rows):
         row = []
-        for j in range(8):
+        for j in range(n_cols):
             if np.isnan(wins[i,j]):
                 row.append('')
             else:
@@ -30,16 +37,22 @@ def __make_annots(wins:np.ndarray, ties:np.ndarray):
         annots.append(row)
     return np.array(annots)
 
-def __prepare_html(wins:np.ndarray, ties:np.ndarray, title:str) -> go.Figure :
+def __prepare_html(wins:np.ndarray, ties:np.ndarray, title:str) -> 'go.Figure' :
     '''
     Returns a plotly heatmap.
     '''
+    import plotly.graph_objects as go
+
     # Settings
     TITLE_SIZE = 22
     LABEL_SIZE = 18
-    TICK_LABEL_SIZE = 16
+    n_sequences = len(wins)
+    scale = max(1, n_sequences / 8) # Grow the figure and shrink the text for longer sequences
+    TICK_LABEL_SIZE = max(8, int(16 / scale))
+    CELL_TEXT_SIZE = max(5, int(13 / scale))
+    SIZE = int(750 * min(scale, 3))
     
-    seqs = ['BBB', 'BBR', 'BRB', 'BRR', 'RBB', 'RBR', 'RRB', 'RRR']
+    seqs = __labels(n_sequences)
 
     annots = __make_annots(wins, ties)
     fig = go.Figure(go.Heatmap(z=wins, x=seqs, y=seqs[::-1],
@@ -50,25 +63,30 @@ def __prepare_html(wins:np.ndarray, ties:np.ndarray, title:str) -> go.Figure :
                                colorbar=dict(ticksuffix='%')
                               ),
                    layout=go.Layout(plot_bgcolor='lightgray'))
-    fig.update_layout(width=750, height=750, 
+    fig.update_layout(width=SIZE, height=SIZE, 
                       title=title, title_font_size=TITLE_SIZE,
                       title_x=0.5, title_y=0.92,
                       xaxis=dict(title='Me', title_font=dict(size=LABEL_SIZE), tickfont=dict(size=TICK_LABEL_SIZE)), 
                       yaxis=dict(title='Opponent', title_font=dict(size=LABEL_SIZE), tickfont=dict(size=TICK_LABEL_SIZE)))
     fig.update_xaxes(showgrid=False)
     fig.update_yaxes(showgrid=False)
-    fig.update_traces(xgap=1, ygap=1, textfont_size=13)
+    fig.update_traces(xgap=1, ygap=1, textfont_size=CELL_TEXT_SIZE)
     fig['layout']['yaxis']['autorange'] = 'reversed'
     return fig
 
 def __create_seaborn(data:np.ndarray, annots:np.ndarray,
-                     ax:plt.Axes = None, hide_yticks:bool = False, title:str = None
-                    ) -> [plt.Figure, plt.Axes]:
+                     ax:'plt.Axes' = None, hide_yticks:bool = False, title:str = None
+                    ) -> ['plt.Figure', 'plt.Axes']:
     '''
     Returns a Seaborn heatmap.
     If ax is None, create a new figure. Otherwise, add the heatmap to the provided ax.
     '''
-    seqs = ['BBB', 'BBR', 'BRB', 'BRR', 'RBB', 'RBR', 'RRB', 'RRR']
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    n_sequences = len(data)
+    seqs = __labels(n_sequences)
+    scale = max(1, n_sequences / 8) # Shrink the text for longer sequences
     
     settings = {
         'vmin': 0,
@@ -77,9 +95,10 @@ def __create_seaborn(data:np.ndarray, annots:np.ndarray,
         'cmap': 'Blues',
         'cbar': False,
         'annot': annots,
+        'annot_kws': {'size': max(3, 10 / scale)},
         'fmt': ''
     }
-    TICKLABEL_SIZE = 12
+    TICKLABEL_SIZE = max(5, int(12 / scale))
     TITLE_SIZE = 18
     
     if ax is None:
@@ -91,8 +110,10 @@ def __create_seaborn(data:np.ndarray, annots:np.ndarray,
 
     sns.heatmap(data=data, ax=ax, **settings)
 
-    ax.set_xticklabels(seqs, fontsize=TICKLABEL_SIZE)
-    ax.set_yticklabels(seqs[::-1], fontsize=TICKLABEL_SIZE)
+    ax.set_xticks(np.arange(n_sequences) + 0.5)
+    ax.set_yticks(np.arange(n_sequences) + 0.5)
+    ax.set_xticklabels(seqs, fontsize=TICKLABEL_SIZE, rotation=90 if n_sequences > 8 else 0)
+    ax.set_yticklabels(seqs[::-1], fontsize=TICKLABEL_SIZE, rotation=0)
     ax.set_title(title, fontsize=TITLE_SIZE)
     ax.set_facecolor('lightgray')
     
@@ -102,13 +123,80 @@ def __create_seaborn(data:np.ndarray, annots:np.ndarray,
     return fig, ax
 
     
-def get_heatmaps(format:str = "html", results_path:str = "results/results.json") -> None:
+def __deck_count(data:dict) -> str:
+    '''
+    Returns the deck count shown in the titles; a snapshot of a run in progress shows how far it got.
+    '''
+    # Antithetic and symmetrized results count several games per deck in n
+    n_decks = data.get('n_decks', data['n'])
+    snapshot = data.get('snapshot')
+    if snapshot and not snapshot['complete']:
+        return f"{n_decks} of {snapshot['total_decks']}"
+    return str(n_decks)
+
+def __html_figures(data:dict) -> tuple:
+    '''
+    Returns the cards and tricks plotly heatmaps for a results dict.
+    '''
+    n = __deck_count(data)
+    cards_fig = __prepare_html(__final_prep(data['cards']), __final_prep(data['cards_ties']),
+                               title=f'My Chance of Winning by Cards<br />(from {n} Random Decks) [Win(Tie)]')
+    tricks_fig = __prepare_html(__final_prep(data['tricks']), __final_prep(data['tricks_ties']),
+                                title=f'My Chance of Winning by Tricks<br />(from {n} Random Decks) [Win(Tie)]')
+    return cards_fig, tricks_fig
+
+def __png_figure(data:dict) -> 'plt.Figure':
+    '''
+    Returns the matplotlib figure with the cards and tricks heatmaps side by side for a results dict.
+    '''
+    import matplotlib.pyplot as plt
+
+    cards = __final_prep(data['cards'])
+    cards_ties = __final_prep(data['cards_ties'])
+    tricks = __final_prep(data['tricks'])
+    tricks_ties = __final_prep(data['tricks_ties'])
+    n = __deck_count(data)
+
+    # Figure specifications
+    LABEL_SIZE = 14
+    scale = min(max(1, len(cards) / 8), 3) # Larger canvas for longer sequences
+    
+    fig, ax = plt.subplots(1, 2, 
+                           figsize=(16*scale,8*scale), 
+                           gridspec_kw={'wspace':.05})
+
+    # Left heatmap
+    cards_annots = __make_annots(cards, cards_ties)
+    __create_seaborn(cards, cards_annots, ax[0], 
+                     title=f'My Chance of Winning by Cards\n(from {n} Random Decks)')
+    ax[0].set_xlabel('Me', fontsize=LABEL_SIZE)
+    ax[0].set_ylabel('Opponent', fontsize=LABEL_SIZE)
+
+    # Right heatmap
+    tricks_annots = __make_annots(tricks, tricks_ties)
+    __create_seaborn(tricks, tricks_annots, ax[1], 
+                     title=f'My Chance of Winning by Tricks\n(from {n} Random Decks)',
+                     hide_yticks=True)
+    ax[1].set_xlabel('Me', fontsize=LABEL_SIZE)
+
+    # Add custom colorbar
+    cbar_ax = fig.add_axes([.92, 0.11, 0.02, .77])
+    cb = fig.colorbar(ax[1].collections[0], cax=cbar_ax, format='%.0f%%')
+    cb.outline.set_linewidth(.2)
+    
+    # Add caption
+    fig.suptitle('Cell text are formatted as follows: Chance of Win (Chance of Tie)', x=0.3, y=0.01)
+    return fig
+
+def get_heatmaps(format:str = "html", results_path:str = "results/results.json", show:bool = True) -> None:
     '''
     Produces two heatmaps using the data in the results folder.
 
     Args:
         format: Takes 'html' or 'png' as input. Determines file format of the saved heatmap.
-        results_path: Defaults to results/results.json. Path to the results file to make heatmaps with.
+        results_path: Defaults to results/results.json. Path to the results file to make heatmaps with;
+            results/snapshot.json shows the partial results of a run in progress.
+        show: Whether to open the html figures after saving them. Use False in headless jobs.
     
     Returns:
         None: Saves the heatmap in the specified format.
@@ -116,61 +204,157 @@ def get_heatmaps(format:str = "html", results_path:str = "results/results.json")
     # Get data
     with open(results_path) as json_file:
         data = json.load(json_file)
-    
-    cards = __final_prep(data['cards'])
-    cards_ties = __final_prep(data['cards_ties'])
-    tricks = __final_prep(data['tricks'])
-    tricks_ties = __final_prep(data['tricks_ties'])
-    n = data['n']
         
     if format == 'html':
-        # Variation 1
-        cards_fig = __prepare_html(cards, cards_ties, title=f'My Chance of Winning by Cards<br />(from {n} Random Decks) [Win(Tie)]')
-        path = 'figures/cards.html'
-        cards_fig.write_html(path)
-        print(f'{path} saved successfully.')
-        cards_fig.show()
-        
-        # Variation 2
-        tricks_fig = __prepare_html(cards, cards_ties, title=f'My Chance of Winning by Tricks<br />(from {n} Random Decks) [Win(Tie)]')
-        path = 'figures/tricks.html'
-        tricks_fig.write_html(path)
-        print(f'{path} saved successfully.')
-        tricks_fig.show()
+        for fig, path in zip(__html_figures(data), ['figures/cards.html', 'figures/tricks.html']):
+            fig.write_html(path)
+            print(f'{path} saved successfully.')
+            if show:
+                fig.show()
     
     elif format == 'png':
-        # Figure specifications
-        LABEL_SIZE = 14
-        TICK_SIZE = 10
-        ANNOT_SIZE = 8
-        
-        fig, ax = plt.subplots(1, 2, 
-                               figsize=(16,8), 
-                               gridspec_kw={'wspace':.05})
-    
-        # Left heatmap
-        cards_annots = __make_annots(cards, cards_ties)
-        __create_seaborn(cards, cards_annots, ax[0], 
-                         title=f'My Chance of Winning by Cards\n(from {n} Random Decks)')
-        ax[0].set_xlabel('Me', fontsize=LABEL_SIZE)
-        ax[0].set_ylabel('Opponent', fontsize=LABEL_SIZE)
-    
-        # Right heatmap
-        tricks_annots = __make_annots(tricks, tricks_ties)
-        __create_seaborn(tricks, tricks_annots, ax[1], 
-                         title=f'My Chance of Winning by Tricks\n(from {n} Random Decks)',
-                         hide_yticks=True)
-        ax[1].set_xlabel('Me', fontsize=LABEL_SIZE)
-    
-        # Add custom colorbar
-        cbar_ax = fig.add_axes([.92, 0.11, 0.02, .77])
-        cb = fig.colorbar(ax[1].collections[0], cax=cbar_ax, format='%.0f%%')
-        cb.outline.set_linewidth(.2)
-        
-        # Add caption
-        fig.suptitle('Cell text are formatted as follows: Chance of Win (Chance of Tie)', x=0.3, y=0.01)
+        import matplotlib.pyplot as plt
+
+        fig = __png_figure(data)
         fig.savefig('figures/heatmaps.png', bbox_inches='tight')
+        plt.close(fig)
     
     else:
         print(f'{format} is not a valid file format. Please use \'png\' or \'html\'.')
     return
+
+
+# Batch rendering
+#
+# Rendered files are named after a hash of everything that determines them: the
+# four matrices, n, the format and RENDER_VERSION (bump it whenever the figure code
+# changes). A file that already exists is therefore up to date and is skipped.
+RENDER_VERSION = 1
+OUTPUT_NAMES = {'html': ['cards.html', 'tricks.html'], 'png': ['heatmaps.png']}
+
+def render_key(data:dict, format:str) -> str:
+    '''
+    Returns the content hash that names the rendered files of a results dict.
+
+    Args:
+        data: Results dict with the four matrices and n.
+        format: 'html' or 'png'.
+
+    Returns:
+        str: Hex SHA-256 digest of the matrices, n and the render settings.
+    '''
+    import hashlib
+
+    content = {key: data[key] for key in ['cards', 'tricks', 'cards_ties', 'tricks_ties', 'n']}
+    content['settings'] = {'format': format, 'version': RENDER_VERSION}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def output_paths(data:dict, format:str, output_folder:str = 'figures/batch') -> list:
+    '''
+    Returns the paths a results dict is rendered to, e.g. figures/batch/<hash>_heatmaps.png.
+    '''
+    key = render_key(data, format)
+    return [f'{output_folder}/{key[:16]}_{name}' for name in OUTPUT_NAMES[format]]
+
+def __init_render_worker() -> None:
+    '''
+    Selects the non-interactive matplotlib backend in a pool worker; the caller's own backend is left alone.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+def __render_job(job:tuple) -> tuple:
+    '''
+    Renders one results file in one format, without showing anything, and returns
+    (results_path, format, paths, rendered, error). A file that cannot be read or
+    rendered gives its error message instead of stopping the other jobs.
+    '''
+    results_path, format, output_folder, force = job
+    try:
+        paths, rendered = __render(results_path, format, output_folder, force)
+        return results_path, format, paths, rendered, None
+    except Exception as error:
+        return results_path, format, [], False, f'{type(error).__name__}: {error}'
+
+def __render(results_path:str, format:str, output_folder:str, force:bool) -> tuple:
+    '''
+    Renders one results file in one format and returns (paths, rendered).
+    Files are written under a temporary name and renamed, so an interrupted job never
+    leaves a file that looks finished.
+    '''
+    import os
+
+    with open(results_path) as json_file:
+        data = json.load(json_file)
+    paths = output_paths(data, format, output_folder)
+    if not force and all(os.path.exists(path) for path in paths):
+        return paths, False
+
+    os.makedirs(output_folder, exist_ok=True)
+    if format == 'html':
+        for fig, path in zip(__html_figures(data), paths):
+            fig.write_html(path + '.tmp', full_html=True)
+            os.replace(path + '.tmp', path)
+    else:
+        import matplotlib.pyplot as plt
+
+        fig = __png_figure(data)
+        fig.savefig(paths[0] + '.tmp', format='png', bbox_inches='tight')
+        plt.close(fig)
+        os.replace(paths[0] + '.tmp', paths[0])
+    return paths, True
+
+def render_many(results_paths:list, formats:list = ('png', 'html'), output_folder:str = 'figures/batch',
+                workers:int = None, force:bool = False) -> dict:
+    '''
+    Renders many results files in parallel, headless, skipping figures that are up to date.
+
+    Args:
+        results_paths: Paths of results.json files (e.g. results/oct28/results.json and new shards).
+        formats: Formats to render each file in, 'png' and/or 'html'.
+        output_folder: Folder for the rendered files, which are named by render_key.
+        workers: Number of worker processes. Defaults to one per core (at most one per job).
+        force: Re-render even when the output files already exist.
+
+    Returns:
+        dict: {results_path: {format: [output paths]}}, or {format: {'error': message}} for a
+        job that failed; the other jobs still run. The mapping is also saved as index.json
+        in output_folder.
+    '''
+    import multiprocessing
+    import os
+
+    jobs = [(path, format, output_folder, force) for path in results_paths for format in formats]
+    if workers is None:
+        workers = min(os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        done = [__render_job(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(workers, initializer=__init_render_worker) as pool:
+            done = pool.map(__render_job, jobs)
+
+    index = {}
+    for results_path, format, paths, rendered, error in done:
+        if error:
+            index.setdefault(results_path, {})[format] = {'error': error}
+            print(f'{results_path} ({format}): failed: {error}')
+            continue
+        index.setdefault(results_path, {})[format] = paths
+        print(f'{results_path} ({format}): {"rendered" if rendered else "unchanged"} -> {", ".join(paths)}')
+    os.makedirs(output_folder, exist_ok=True)
+    with open(f'{output_folder}/index.json', 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    return index
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render heatmaps for many results files without showing them.")
+    parser.add_argument('results_paths', nargs='+', help="results.json files to render")
+    parser.add_argument('-f', '--formats', nargs='+', choices=['png', 'html'], default=['png', 'html'])
+    parser.add_argument('-o', '--output-folder', default='figures/batch')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help="re-render figures that are up to date")
+    args = parser.parse_args()
+    render_many(args.results_paths, args.formats, args.output_folder, args.workers, args.force)